@@ -0,0 +1,57 @@
+import os
+import threading
+import httpx
+from mistralai import Mistral
+from langchain_google_genai import ChatGoogleGenerativeAI
+
+# process wide registry of agents and the llm clients behind them.
+# every agent (and every client) is created once and then shared across requests,
+# so requests reuse the same connection pools instead of paying for client setup
+# and tls handshakes each time. agents hold no per-request state, so sharing them
+# between threads is safe.
+class AgentRegistry:
+    def __init__(self, max_connections = 20, max_keepalive_connections = 10, keepalive_expiry = 60, timeout = 120):
+        self.lock = threading.RLock()
+        self.agents = {}
+        self.clients = {}
+        self.http_limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.http_timeout = timeout
+
+    def _get_or_create(self, registry, key, factory):
+        value = registry.get(key)
+        if value is not None:
+            return value
+        with self.lock:
+            value = registry.get(key)
+            if value is None:
+                value = factory()
+                registry[key] = value
+            return value
+
+    def get(self, agent_class, **kwargs):
+        key = (agent_class, tuple(sorted(kwargs.items())))
+        return self._get_or_create(self.agents, key, lambda: agent_class(**kwargs))
+
+    def get_gemini_client(self, model):
+        return self._get_or_create(self.clients, ("gemini", model), lambda: self._create_gemini_client(model))
+
+    def get_mistral_client(self):
+        return self._get_or_create(self.clients, ("mistral",), self._create_mistral_client)
+
+    def _create_gemini_client(self, model):
+        print(f"[AGENT REGISTRY] CREATING GEMINI CLIENT : {model}")
+        return ChatGoogleGenerativeAI(model=model)
+
+    def _create_mistral_client(self):
+        print("[AGENT REGISTRY] CREATING MISTRAL CLIENT")
+        return Mistral(
+            api_key = os.environ["MISTRAL_API_KEY"],
+            client = httpx.Client(limits=self.http_limits, timeout=self.http_timeout),
+            async_client = httpx.AsyncClient(limits=self.http_limits, timeout=self.http_timeout)
+        )
+
+agent_registry = AgentRegistry()
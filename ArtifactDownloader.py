@@ -0,0 +1,240 @@
+import hashlib
+import mimetypes
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from urllib.parse import urlparse
+
+import filetype
+import requests
+from requests.adapters import HTTPAdapter
+
+from RetryPolicy import RetryPolicy
+
+# downloads knowledge artifacts for the ingestion workers, several workers download at the same time.
+# every worker thread keeps its own pooled session so connections to the object store are reused.
+# a sqlite manifest remembers the etag, last modified date and content hash of every ingested artifact:
+# conditional requests (If-None-Match / If-Modified-Since) and the content hash let unchanged artifacts
+# be skipped, and an interrupted download is resumed with a range request when the server allows it.
+class ArtifactDownloader:
+    def __init__(self, manifest_path = "database/environment/artifact_manifest.db", chunk_size = 2**20, max_size = 200 * 2**20, connect_timeout = 10, read_timeout = 60, download_timeout = 600, pool_size = 10, retry_policy = None):
+        self.manifest_path = manifest_path
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.download_timeout = download_timeout
+        self.pool_size = pool_size
+        # connection failures and 5xx responses are retried, resuming from what was already written
+        self.retry_policy = retry_policy or RetryPolicy(max_retries=3, base_delay=1, max_delay=10, retry_on=(requests.RequestException,))
+        self.sessions = threading.local()
+
+        Path(os.path.dirname(manifest_path) or '.').mkdir(parents=True, exist_ok=True)
+        self._create_tables()
+
+    @contextmanager
+    def _connect(self):
+        connection = sqlite3.connect(self.manifest_path, timeout=30, isolation_level=None)
+        try:
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            yield connection
+        finally:
+            connection.close()
+
+    def _create_tables(self):
+        with self._connect() as connection:
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS artifacts (
+                    customer_id TEXT NOT NULL,
+                    artifact_id TEXT NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    sha256 TEXT NOT NULL,
+                    extension TEXT,
+                    size INTEGER NOT NULL,
+                    ingested_at REAL NOT NULL,
+                    PRIMARY KEY (customer_id, artifact_id)
+                );
+                CREATE TABLE IF NOT EXISTS partial_downloads (
+                    customer_id TEXT NOT NULL,
+                    artifact_id TEXT NOT NULL,
+                    etag TEXT NOT NULL,
+                    PRIMARY KEY (customer_id, artifact_id)
+                );
+            """)
+
+    def get_session(self):
+        session = getattr(self.sessions, "session", None)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self.sessions.session = session
+        return session
+
+    def get_manifest_entry(self, customer_id, artifact_id):
+        with self._connect() as connection:
+            entry = connection.execute(
+                "SELECT * FROM artifacts WHERE customer_id = ? AND artifact_id = ?",
+                (str(customer_id), str(artifact_id))
+            ).fetchone()
+        return dict(entry) if entry is not None else None
+
+    # to be called once the downloaded artifact has been ingested, so a failed ingestion is retried in full
+    def commit(self, customer_id, artifact_id, download):
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO artifacts (customer_id, artifact_id, etag, last_modified, sha256, extension, size, ingested_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (str(customer_id), str(artifact_id), download["etag"], download["last_modified"], download["sha256"], download["extension"], download["size"], time.time())
+            )
+
+    # deleted artifacts have to be downloaded and ingested again when they are uploaded again
+    def forget(self, customer_id, artifact_ids):
+        with self._connect() as connection:
+            connection.executemany(
+                "DELETE FROM artifacts WHERE customer_id = ? AND artifact_id = ?",
+                [(str(customer_id), str(artifact_id)) for artifact_id in artifact_ids]
+            )
+
+    # returns {"status": "downloaded" | "not_modified" | "unchanged", "path", "extension", "etag", "last_modified", "sha256", "size"}.
+    # not_modified means the server answered 304, unchanged that the content hash matches the last ingestion.
+    # path is None unless the status is downloaded, then previously_ingested tells whether another version
+    # of the artifact was ingested before.
+    def download(self, customer_id, artifact_id, artifact_url, directory):
+        entry = self.get_manifest_entry(customer_id, artifact_id)
+        return self.retry_policy.call(self._download, customer_id, artifact_id, artifact_url, directory, entry)
+
+    def _download(self, customer_id, artifact_id, artifact_url, directory, entry):
+        os.makedirs(directory, exist_ok=True)
+        part_path = f"{directory}/{artifact_id}.part"
+        headers = {}
+
+        if entry is not None:
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        # an interrupted download is continued only if the server still has the same version (If-Range)
+        resume_from = 0
+        partial_etag = self._get_partial_etag(customer_id, artifact_id)
+        if partial_etag and os.path.exists(part_path):
+            resume_from = os.path.getsize(part_path)
+            if resume_from != 0:
+                headers["Range"] = f"bytes={resume_from}-"
+                headers["If-Range"] = partial_etag
+
+        started_at = time.monotonic()
+        with self.get_session().get(artifact_url, headers=headers, stream=True, allow_redirects=True, timeout=self.timeout) as response:
+            if response.status_code == 304 and entry is not None:
+                print(f"[ARTIFACT DOWNLOADER] NOT MODIFIED, SKIPPING DOWNLOAD : {artifact_id}")
+                return {**self._describe(entry), "status": "not_modified", "path": None}
+
+            if response.status_code >= 500:
+                raise requests.HTTPError(f"[ARTIFACT DOWNLOADER:ERROR] DOWNLOAD FAILED WITH STATUS {response.status_code} : {artifact_url}")
+            if response.status_code not in (200, 206):
+                raise Exception(f"[ARTIFACT DOWNLOADER:ERROR] DOWNLOAD FAILED WITH STATUS {response.status_code} : {artifact_url}")
+
+            # the server ignored the range (or the artifact changed), start over
+            if response.status_code == 200:
+                resume_from = 0
+
+            content_length = response.headers.get("Content-Length")
+            if content_length and content_length.isdigit() and resume_from + int(content_length) > self.max_size:
+                raise Exception(f"[ARTIFACT DOWNLOADER:ERROR] ARTIFACT OF {resume_from + int(content_length)} BYTES EXCEEDS THE LIMIT OF {self.max_size} BYTES : {artifact_id}")
+
+            etag = response.headers.get("ETag")
+            if resume_from == 0:
+                self._set_partial_etag(customer_id, artifact_id, etag)
+            else:
+                etag = etag or partial_etag
+                print(f"[ARTIFACT DOWNLOADER] RESUMING DOWNLOAD AT {resume_from} BYTES : {artifact_id}")
+
+            content_hash = hashlib.sha256()
+            size = resume_from
+            if resume_from != 0:
+                with open(part_path, "rb") as part_file:
+                    for chunk in iter(lambda: part_file.read(self.chunk_size), b""):
+                        content_hash.update(chunk)
+
+            with open(part_path, "ab" if resume_from != 0 else "wb") as part_file:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    size += len(chunk)
+                    if size > self.max_size:
+                        self._discard(customer_id, artifact_id, part_path)
+                        raise Exception(f"[ARTIFACT DOWNLOADER:ERROR] ARTIFACT EXCEEDS THE LIMIT OF {self.max_size} BYTES : {artifact_id}")
+                    if time.monotonic() - started_at > self.download_timeout:
+                        raise Exception(f"[ARTIFACT DOWNLOADER:ERROR] DOWNLOAD TOOK LONGER THAN {self.download_timeout}s : {artifact_id}")
+                    content_hash.update(chunk)
+                    part_file.write(chunk)
+
+            content_type = response.headers.get("Content-Type")
+            last_modified = response.headers.get("Last-Modified")
+
+        self._clear_partial_etag(customer_id, artifact_id)
+        sha256 = content_hash.hexdigest()
+        download = {
+            "etag": etag,
+            "last_modified": last_modified,
+            "sha256": sha256,
+            "size": size
+        }
+
+        if entry is not None and entry["sha256"] == sha256:
+            print(f"[ARTIFACT DOWNLOADER] CONTENT UNCHANGED SINCE LAST INGESTION : {artifact_id}")
+            os.remove(part_path)
+            return {**download, "extension": entry["extension"], "status": "unchanged", "path": None}
+
+        extension = self.detect_extension(part_path, content_type, artifact_url)
+        path = f"{directory}/{artifact_id}{extension or ''}"
+        os.replace(part_path, path)
+        print(f"[ARTIFACT DOWNLOADER] DOWNLOADED {size} BYTES AS {extension} : {artifact_id}")
+        return {**download, "extension": extension, "status": "downloaded", "path": path, "previously_ingested": entry is not None}
+
+    # the content decides the type. text has no signature, so it falls back to the content type and the url
+    def detect_extension(self, path, content_type = None, artifact_url = None):
+        kind = filetype.guess(path)
+        if kind is not None:
+            return f".{kind.extension}"
+        if content_type:
+            extension = mimetypes.guess_extension(content_type.split(";")[0].strip())
+            if extension:
+                return extension
+        if artifact_url:
+            extension = os.path.splitext(urlparse(artifact_url).path)[1]
+            if extension:
+                return extension.lower()
+        return None
+
+    def _describe(self, entry):
+        return {key: entry[key] for key in ("etag", "last_modified", "sha256", "size", "extension")}
+
+    def _discard(self, customer_id, artifact_id, part_path):
+        self._clear_partial_etag(customer_id, artifact_id)
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+    def _get_partial_etag(self, customer_id, artifact_id):
+        with self._connect() as connection:
+            partial = connection.execute(
+                "SELECT etag FROM partial_downloads WHERE customer_id = ? AND artifact_id = ?",
+                (str(customer_id), str(artifact_id))
+            ).fetchone()
+        return partial["etag"] if partial is not None else None
+
+    def _set_partial_etag(self, customer_id, artifact_id, etag):
+        with self._connect() as connection:
+            if etag:
+                connection.execute(
+                    "INSERT OR REPLACE INTO partial_downloads (customer_id, artifact_id, etag) VALUES (?, ?, ?)",
+                    (str(customer_id), str(artifact_id), etag)
+                )
+            else:
+                connection.execute("DELETE FROM partial_downloads WHERE customer_id = ? AND artifact_id = ?", (str(customer_id), str(artifact_id)))
+
+    def _clear_partial_etag(self, customer_id, artifact_id):
+        self._set_partial_etag(customer_id, artifact_id, None)
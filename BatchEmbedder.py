@@ -0,0 +1,45 @@
+from concurrent.futures import ThreadPoolExecutor
+from RetryPolicy import RetryPolicy, is_rate_limit_error
+
+# wraps any langchain style embedder (embed_query / embed_documents) and embeds
+# documents in fixed size batches, with a bounded number of batches in flight
+# and every batch retried independently.
+class BatchEmbedder:
+    def __init__(self, embedder, batch_size = 100, max_concurrent_batches = 4, retry_policy = None):
+        if batch_size < 1 or max_concurrent_batches < 1:
+            raise Exception("[BATCH EMBEDDER:ERROR] batch_size AND max_concurrent_batches MUST BE AT LEAST 1")
+
+        self.embedder = embedder
+        self.batch_size = batch_size
+        self.max_concurrent_batches = max_concurrent_batches
+        # only rate limit errors are retried, bad input or auth errors come back right away
+        self.retry_policy = retry_policy or RetryPolicy(retry_if=is_rate_limit_error)
+        # shared across calls so concurrent uploads are bounded together
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrent_batches, thread_name_prefix="embedder")
+
+    def embed_query(self, text):
+        return self.retry_policy.call(self.embedder.embed_query, text)
+
+    async def aembed_query(self, text):
+        return await self.retry_policy.acall(self.embedder.aembed_query, text)
+
+    def embed_documents(self, texts):
+        texts = list(texts)
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        print(f"[BATCH EMBEDDER] EMBEDDING {len(texts)} TEXTS IN {len(batches)} BATCHES")
+
+        if len(batches) <= 1:
+            results = [self._embed_batch(batch) for batch in batches]
+        else:
+            results = self.executor.map(self._embed_batch, batches)
+
+        vectors = []
+        for batch_vectors in results:
+            vectors.extend(batch_vectors)
+        return vectors
+
+    def _embed_batch(self, batch):
+        vectors = self.retry_policy.call(self.embedder.embed_documents, batch)
+        if len(vectors) != len(batch):
+            raise Exception(f"[BATCH EMBEDDER:ERROR] EXPECTED {len(batch)} VECTORS, GOT {len(vectors)}")
+        return vectors
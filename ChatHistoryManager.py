@@ -1,43 +1,58 @@
 from uuid import uuid4
 from datetime import datetime
-import json
 
+# chat history of every (customer, user) is kept as append-only rows in the chat history store
+# (the sqlite user context store), trimmed to the chat_history_window_limit latest records. an
+# append inserts the new records only, it never reads or rewrites the user context or the rest of
+# the history, and appends of different users do not wait on each other.
 class ChatHistoryManager:
-    def __init__(self, resource_manager=None):
+    def __init__(self, resource_manager=None, chat_history_store=None, chat_history_window_limit=None):
         self.resource_manager = resource_manager
+        self.chat_history_store = chat_history_store
 
-    def append(self, customer_id, user_id, by, type, content):
-        chat_record = {
+        if chat_history_window_limit is None:
+            config = self.resource_manager.get("file_system/database/environment/config.json")
+            chat_history_window_limit = config.get("chat_history_window_limit")
+        self.chat_history_window_limit = chat_history_window_limit
+
+    def create_record(self, by, type, content):
+        return {
             "chat_id": str(uuid4()),
             "from": by,
             "timestamp": str(datetime.now()),
             "type": type,
             "content": content
         }
-        
-        config = self.resource_manager.get("file_system/database/environment/config.json")
-        user_context = self.resource_manager.get(f"user_context/{customer_id}{user_id}")
 
-        if not user_context:
+    # replaces the chat history, to be called whenever the user context is replaced from outside
+    def reset(self, customer_id, user_id, chat_history=None):
+        self.chat_history_store.replace_chat_history(f"{customer_id}{user_id}", list(chat_history or []), self.chat_history_window_limit)
+
+    def get_history(self, customer_id, user_id):
+        return self.chat_history_store.read_chat_history(f"{customer_id}{user_id}")
+
+    def append(self, customer_id, user_id, by, type, content):
+        return self.append_many(customer_id, user_id, [(by, type, content)])[0]
+
+    # appends several (by, type, content) messages, e.g. a whole query turn, with a single write
+    def append_many(self, customer_id, user_id, messages):
+        chat_records = [self.create_record(by, type, content) for by, type, content in messages]
+        return self.append_records(customer_id, user_id, chat_records)
+
+    # appends records made with create_record, for records that were already sent out (e.g. streamed)
+    def append_records(self, customer_id, user_id, chat_records):
+        key = f"{customer_id}{user_id}"
+
+        # cached by the resource manager, only checks that the user has connected
+        user_context = self.resource_manager.get(f"user_context/{key}")
+        if user_context is None:
             raise Exception("User has not connected yet. chat history unavailable. please use the /connect endpoint to do the same")
-        
-        if not user_context.get("chat_history"):
-            user_context["chat_history_size"] = 0
-            user_context["chat_history"]= []
-        
-        if not user_context.get("chat_history_size"):
-            user_context["chat_history_size"] = len(user_context.get("chat_history"))
-        
-        if user_context["chat_history_size"] + 1 > config.get("chat_history_window_limit"):
-            print('aalu')
-            user_context["chat_history"].pop(0)  # Remove the oldest chat
-            print("gobi")
-            user_context["chat_history_size"] -= 1
-        
-        print('baian')
-        user_context["chat_history"].append(chat_record)
-        user_context["chat_history_size"] += 1
-
-        self.resource_manager.set(f'user_context/{customer_id}{user_id}', user_context)
-
-        return chat_record
+
+        # contexts written before the history had its own rows carry it inline, moved over once
+        if "chat_history" in user_context:
+            self.reset(customer_id, user_id, user_context.pop("chat_history"))
+            user_context.pop("chat_history_size", None)
+            self.resource_manager.set(f'user_context/{key}', user_context)
+
+        self.chat_history_store.append_chat_records(key, chat_records, self.chat_history_window_limit)
+        return chat_records
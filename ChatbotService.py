@@ -0,0 +1,737 @@
+import asyncio
+import json
+import os
+import re
+import threading
+import time
+
+from FileSystemInterface import FileSystemInterface
+from UserContextInterface import UserContextInterface
+from CustomerConfigInterface import CustomerConfigInterface
+from ResourceManager import ResourceManager
+from ChatHistoryManager import   ChatHistoryManager
+from DefaultConfigManager import DefaultConfigManager
+from KnowledgeIngestor import KnowledgeIngestor
+from IngestionJobQueue import IngestionJobQueue
+from ArtifactDownloader import ArtifactDownloader
+from MongoConnectionManager import mongo_connection_manager
+from SemanticAnswerCache import SemanticAnswerCache, get_knowledge_fingerprint
+from Reranker import CrossEncoderReranker
+
+from rag import ContextBuilder, VectorStoreManager
+from agents import QueryPreprocessingAgent, QueryAnsweringAgent, ImageDescriptionRelavancyCheckAgent, WatchmanAgent
+from AgentRegistry import agent_registry
+
+# finds the response code (e.g. "OK" / "IDK") at the start of a streamed answer. tokens are only held
+# back while they could still turn into a response code, everything after it is passed straight through.
+class ResponseCodeDetector:
+    def __init__(self, response_codes, default_response_code):
+        self.response_codes = response_codes or []
+        self.response_code = default_response_code
+        self.buffer = ""
+        self.detected = False
+        # whitespace between the response code and the answer is dropped
+        self.strip_leading = False
+
+    # returns the (event, data) pairs to send for this token
+    def feed(self, token):
+        if self.detected:
+            return self._emit(token)
+        self.buffer += token
+        if any(len(code) > len(self.buffer) and code.startswith(self.buffer) for code in self.response_codes):
+            return []
+        return self._detect()
+
+    def finish(self):
+        if self.detected:
+            return []
+        return self._detect()
+
+    def _detect(self):
+        self.detected = True
+        text = self.buffer
+        # first matching code wins, like the alternation used by the blocking endpoint
+        for code in self.response_codes:
+            if text.startswith(code):
+                self.response_code = code
+                text = text[len(code):]
+                self.strip_leading = True
+                break
+        return [("response_code", {"response_code": self.response_code}), *self._emit(text)]
+
+    def _emit(self, text):
+        if self.strip_leading:
+            text = text.lstrip()
+            if not text:
+                return []
+            self.strip_leading = False
+        if not text:
+            return []
+        return [("token", {"content": text})]
+
+# what can end up in a knowledge base as an image, either uploaded or extracted from a pdf
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".gif", ".bmp", ".tiff", ".webp", ".jpx", ".jp2"}
+
+# images are stored under the hash of their content, so a url never changes what it points to
+IMAGE_CACHE_MAX_AGE = 31536000
+
+def to_server_sent_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+# the chatbot api independent of the web framework serving it. every handler takes the parsed
+# json body and returns (payload, status_code), app.py (flask) and asgi.py (quart) only wrap them in routes.
+# with native_async the llm calls, query embeddings and vector store reads use the async clients.
+# that is only safe when every request runs on the same long lived event loop (asgi), the flask dev
+# server runs each async view on a fresh loop, so there the blocking clients are run in threads instead.
+class ChatbotService:
+    def __init__(self, native_async = False, system_config_path = "database/environment/config.json"):
+        self.native_async = native_async
+
+        file_system_interface = FileSystemInterface()
+        system_config = file_system_interface.read(system_config_path)
+        mongo_connection_manager.configure(**system_config.get("mongo_pool", {}))
+
+        user_context_interface = UserContextInterface(filename="database/environment/user_contexts.db", legacy_filename="database/environment/user_contexts.json")
+        self.rm = ResourceManager(
+            cache_size = system_config.get("resource_cache_size", 100),
+            location_interface_map = {
+                     "file_system": file_system_interface,
+                     "user_context": user_context_interface,
+                     "customer_config":CustomerConfigInterface(db_url = "mongodb://localhost:27017/")
+                 },
+            write_behind = system_config.get("resource_write_behind", False),
+            flush_interval = system_config.get("resource_flush_interval", 5),
+            ttls = system_config.get("resource_ttls")
+        )
+        self.chat_history_manager = ChatHistoryManager(
+            resource_manager=self.rm,
+            chat_history_store=user_context_interface,
+            chat_history_window_limit=system_config.get("chat_history_window_limit")
+        )
+        self.default_config_manager = DefaultConfigManager(resource_manager=self.rm)
+        self.vsi = VectorStoreManager(
+            db_url = "mongodb://localhost:27017/",
+            db_name = "toofan_local",
+            index_mode = system_config.get("vector_index_mode", "flat"),
+            retrieval_mode = system_config.get("retrieval_mode", "vector"),
+            lexical_weight = system_config.get("hybrid_lexical_weight", 0.5),
+            rrf_k = system_config.get("hybrid_rrf_k", 60),
+            lexical_prefilter_size = system_config.get("lexical_prefilter_size"),
+            embedding_batch_size = system_config.get("embedding_batch_size", 100),
+            embedding_max_concurrent_batches = system_config.get("embedding_max_concurrent_batches", 4),
+            embedding_cache_size = system_config.get("embedding_cache_size", 10000),
+            embedding_disk_cache_directory = system_config.get("embedding_disk_cache_directory"),
+            embedding_disk_cache_size_limit = system_config.get("embedding_disk_cache_size_limit", 2**30),
+            index_sync_interval = system_config.get("vector_index_sync_interval", 5)
+        )
+        self.answer_cache = SemanticAnswerCache(**system_config.get("answer_cache", {}))
+        self.context_builder = ContextBuilder(**system_config.get("context_builder", {}))
+        self.reranker = CrossEncoderReranker(**system_config.get("reranker", {}))
+        # downloads run on the ingestion workers, so ingestion_workers artifacts are fetched concurrently
+        self.knowledge_ingestor = KnowledgeIngestor(
+            resource_manager=self.rm,
+            vector_store_manager=self.vsi,
+            artifact_downloader=ArtifactDownloader(**system_config.get("artifact_download", {})),
+            answer_cache=self.answer_cache,
+            knowledge_digest_token_budget=system_config.get("knowledge_digest_token_budget", 2000)
+        )
+        self.ingestion_job_queue = IngestionJobQueue(
+            processor = self.knowledge_ingestor.ingest,
+            database_path = system_config.get("ingestion_queue_path", "database/environment/ingestion_queue.db"),
+            num_workers = system_config.get("ingestion_workers", 4),
+            lease_duration = system_config.get("ingestion_lease_duration", 60),
+            downloader = self.knowledge_ingestor.download,
+            num_download_workers = system_config.get("download_workers", 8)
+        )
+
+    def start(self):
+        self.vsi.load_known_collections()
+        self.ingestion_job_queue.start()
+
+    def stop(self):
+        self.ingestion_job_queue.stop()
+        self.rm.close()
+
+    # blocking work (resource manager, sqlite, pymongo) never runs on the event loop itself
+    async def _run(self, function, *args):
+        return await asyncio.to_thread(function, *args)
+
+    # agent_method is the blocking method, its async counterpart is named with an "a" prefix
+    async def _call_agent(self, agent_class, agent_method, *args):
+        agent = agent_registry.get(agent_class)
+        if self.native_async:
+            return await getattr(agent, f"a{agent_method}")(*args)
+        return await self._run(getattr(agent, agent_method), *args)
+
+    async def _embed_query(self, query):
+        if self.native_async:
+            return await self.vsi.aembed_query(query)
+        return await self._run(self.vsi.embed_query, query)
+
+    async def _retrieve(self, vector_store_name, query, query_vector, k = 5):
+        if self.native_async:
+            return await self.vsi.aretrieve(vector_store_name, query, query_vector=query_vector, k=k)
+        return await self._run(self.vsi.retrieve, vector_store_name, query, query_vector, k)
+
+    # with the reranker enabled the vector store returns its top candidates and the reranker keeps the best few
+    async def _retrieve_chunks(self, vector_store_name, query, query_vector):
+        if not self.reranker.enabled:
+            return await self._retrieve(vector_store_name, query, query_vector)
+        candidates = await self._retrieve(vector_store_name, query, query_vector, self.reranker.candidates)
+        return await self.reranker.arerank(query, candidates)
+
+    def health(self):
+        return {
+            "status":"healthy",
+            "embedding_cache":self.vsi.get_embedding_cache_stats(),
+            "resource_cache":self.rm.get_stats(),
+            "answer_cache":self.answer_cache.get_stats(),
+            "reranker":self.reranker.get_stats(),
+            "mongo_pool":mongo_connection_manager.get_metrics()
+        },200
+
+    async def connect(self, body):
+        try:
+            customer_id = body.get("customer_id")
+            user_id = body.get("user_id")
+            user_context = body.get("context")
+
+            if not user_context:
+                user_context = {}
+
+            # the chat history is stored apart from the rest of the context
+            chat_history = user_context.pop("chat_history", None) or []
+
+            print(user_context)
+
+            await self._run(self.chat_history_manager.reset, customer_id, user_id, chat_history)
+            await self._run(self.rm.set, f"user_context/{customer_id}{user_id}", user_context)
+
+            # config = rm.get(f'file_system/database/services/{customer_id}/config.json')
+            config = await self._run(self.rm.get, f'customer_config/{customer_id}')
+
+            if not config:
+                raise Exception("customer config not found. maybe customer doesnt exist. use /config endpoint to create customer config")
+
+            welcome_chat_context = await self._run(self.chat_history_manager.append, customer_id, user_id, "bot", "text", config["custom_welcome_message"])
+
+            return {
+                    "result":"true",
+                    "message":"connected",
+                    "chat_response":[{**welcome_chat_context }]
+                },200
+
+        except Exception as e:
+            print(e)
+            return {
+                "result":"false",
+                "message":str(e),
+            },400
+
+    async def update_config(self, body):
+        try:
+            print("MODIFYING CONFIGURATION")
+            customer_id = body.get("customer_id")
+            config_updates = body.get("config")
+
+            config_already_exists = await self._run(self._update_config, customer_id, config_updates)
+            # answers depend on the customer's settings as well
+            self.answer_cache.invalidate(customer_id)
+
+            if config_already_exists:
+                return {
+                    "result":"true",
+                    "message":"config created",
+                },201
+
+            return {
+                "result":"true",
+                "message":"config updated",
+            },200
+        except Exception as e:
+            print(e)
+            return {
+                "result":"false",
+                "message":"invalid request",
+            },400
+
+    # the knowledge ingestor writes knowledge_summaries and knowledge_digest into the same config in the
+    # background, so the read-modify-write happens under its per-customer lock. returns whether the config was created
+    def _update_config(self, customer_id, config_updates):
+        with self.knowledge_ingestor.get_customer_lock(customer_id):
+            config = self.rm.get(f'customer_config/{customer_id}')
+            config_already_exists = False
+
+            if not config:
+                # creating config with default value
+                config = self.default_config_manager.get_default_config(customer_id)
+                config_already_exists = True
+
+            # updating config
+            for key, value in config_updates.items():
+                config[key] = value
+
+            self.rm.set(f'customer_config/{customer_id}', config)
+            return config_already_exists
+
+    # loads everything a query needs, shared by the blocking and the streaming query endpoints
+    async def _prepare_query(self, body):
+        customer_id = body.get("customer_id")
+        user_id = body.get("user_id")
+        query = body.get("query")
+
+        # read before the config the answer is based on, an invalidation after this point keeps the answer out of the cache
+        cache_generation = self.answer_cache.get_generation(customer_id)
+
+        customer_config = await self._run(self.rm.get, f'customer_config/{customer_id}')
+        print(customer_config)
+        if not customer_config:
+            raise Exception("customer doesnt exist. configure customer using /config")
+
+        system_config = await self._run(self.rm.get, f'file_system/database/environment/config.json')
+        print(system_config.get("query_response_codes"))
+        print(system_config.get("default_response_code"))
+
+        return {
+            "started_at": time.monotonic(),
+            "cache_generation": cache_generation,
+            "customer_id": customer_id,
+            "user_id": user_id,
+            "query": query,
+            "customer_config": customer_config,
+            "knowledge_fingerprint": get_knowledge_fingerprint(customer_config),
+            "query_response_codes": system_config.get("query_response_codes"),
+            "default_response_code": system_config.get("default_response_code"),
+            "query_fanout_concurrency": system_config.get("query_fanout_concurrency", 4),
+            "batch_classifiers": system_config.get("batch_classifiers", True)
+        }
+
+    # breaks the query up and runs every sub-query's guard -> retrieve -> relevancy check pipeline
+    # concurrently, bounded by query_fanout_concurrency. yields (position, documents, top_image_document)
+    # position being the index of the sub-query.
+    # with batch_classifiers every sub-query is guarded by one llm call up front and every candidate
+    # image is judged by one llm call once all retrievals are done, otherwise each sub-query makes its
+    # own calls and results are yielded as each sub-query finishes.
+    async def _retrieve_for_query(self, prepared):
+        customer_id = prepared["customer_id"]
+        customer_config = prepared["customer_config"]
+        allow_multimodal_for_images = customer_config["allow_multimodal_for_images"]
+        use_query_filtering = customer_config["use_query_filtering"]
+        batch_classifiers = prepared["batch_classifiers"]
+
+        vector_store_name = f"{customer_id}_vector_store"
+        image_vector_store_name = f"{customer_id}_image_vector_store"
+
+        print("BREAKING QUERY...")
+        # started by _lookup_answer next to the cache lookup
+        if "broken_query" in prepared:
+            queries = await prepared["broken_query"]
+        else:
+            queries = await self._call_agent(QueryPreprocessingAgent, "break_query", prepared["query"])
+        print(queries)
+
+        print("FETCHING KNOWLEDGE SUMMARIES")
+        # the digest is maintained by the knowledge ingestor, configs written before it existed have none
+        knowledge_digest = customer_config.get("knowledge_digest")
+        if knowledge_digest is not None:
+            aggregate_summary = knowledge_digest["text"]
+        else:
+            aggregate_summary = "\n".join(ks.get("artifact_summary") for ks in customer_config["knowledge_summaries"])
+
+        general_queries = [False] * len(queries)
+        if use_query_filtering and batch_classifiers:
+            general_queries = await self._call_agent(WatchmanAgent, "guard_batch", queries, aggregate_summary)
+
+        fanout_semaphore = asyncio.Semaphore(prepared["query_fanout_concurrency"])
+
+        async def process_sub_query(position, q):
+            async with fanout_semaphore:
+                if use_query_filtering and not batch_classifiers:
+                    watchman_agent_decision = await self._call_agent(WatchmanAgent, "guard", q, aggregate_summary)
+                    general_queries[position] = "yes" in watchman_agent_decision.lower()
+                if general_queries[position]:
+                    print(f'{q} is general')
+                    return position, [], None
+                if use_query_filtering:
+                    print(f'{q} is specific')
+
+                query_vector = await self._embed_query(q)
+                retrievals = [self._retrieve_chunks(vector_store_name, q, query_vector)]
+                if allow_multimodal_for_images:
+                    retrievals.append(self._retrieve(image_vector_store_name, q, query_vector))
+                retrieval_results = await asyncio.gather(*retrievals)
+
+                candidate_image_document = None
+                if allow_multimodal_for_images:
+                    retrieved_image_documents = retrieval_results[1]
+                    if len(retrieved_image_documents) == 0:
+                        raise Exception("[UPLOAD:ERROR] IMAGE VECTOR STORE IS EMPTY, DISABLE allow_multimodal_for_images")
+                    candidate_image_document = retrieved_image_documents[0]
+
+                if candidate_image_document is not None and not batch_classifiers:
+                    relavancy_check_decision = await self._call_agent(ImageDescriptionRelavancyCheckAgent, "answer_query", q, candidate_image_document.page_content, candidate_image_document.page_content)
+                    print(relavancy_check_decision)
+                    if "yes" not in relavancy_check_decision.lower():
+                        candidate_image_document = None
+
+                return position, retrieval_results[0], candidate_image_document
+
+        tasks = [asyncio.create_task(process_sub_query(position, q)) for position, q in enumerate(queries)]
+        try:
+            if not batch_classifiers:
+                for next_finished in asyncio.as_completed(tasks):
+                    yield await next_finished
+                return
+
+            results = await asyncio.gather(*tasks)
+            candidates = [(position, candidate_image_document) for position, documents, candidate_image_document in results if candidate_image_document is not None]
+            relevant = await self._call_agent(ImageDescriptionRelavancyCheckAgent, "judge_batch", [(queries[position], d.page_content) for position, d in candidates])
+            relevant_positions = {position for (position, d), is_relevant in zip(candidates, relevant) if is_relevant}
+            print(f"{len(relevant_positions)} OF {len(candidates)} CANDIDATE IMAGES ARE RELAVANT")
+
+            for position, documents, candidate_image_document in results:
+                yield position, documents, candidate_image_document if position in relevant_positions else None
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    # sub_query_results are the (position, documents, top_image_document) of every sub-query in sub-query order.
+    # relevant images are always part of the context, the chunks are packed to the context builder's token budget
+    def _build_context(self, customer_id, sub_query_results):
+        documents = [d for position, documents, top_image_document in sub_query_results for d in documents]
+        image_documents = [top_image_document for position, documents, top_image_document in sub_query_results if top_image_document is not None]
+        vectors = None
+        if self.context_builder.mmr_lambda is not None:
+            vectors = self.vsi.get_vectors(f"{customer_id}_vector_store", [d.metadata.get("id") for d in documents])
+        return self.context_builder.build(documents, image_documents, vectors)
+
+    # chat records only carry a reference to the image, served by get_image_path()
+    def get_image_reference(self, customer_id, image_document):
+        return f'/chatbot/api/v1/images/{customer_id}/{os.path.basename(image_document.metadata.get("source"))}'
+
+    # absolute path of an image in a customer's knowledge base, None if the request does not name one
+    def get_image_path(self, customer_id, filename):
+        for name in (str(customer_id), filename):
+            if not name or name.startswith(".") or os.path.basename(name) != name or "\\" in name:
+                return None
+        if os.path.splitext(filename)[1].lower() not in IMAGE_EXTENSIONS:
+            return None
+        image_path = os.path.abspath(f'database/services/{customer_id}/knowledge_base/{filename}')
+        if not os.path.isfile(image_path):
+            return None
+        return image_path
+
+    # looks the whole query up in the semantic answer cache. the whole query is embedded (needed to store
+    # the answer) while the cache is checked. breaking the query up is only started once the answer is known
+    # not to be cached: right away for customers without cached answers, after the lookup otherwise
+    async def _lookup_answer(self, prepared):
+        if not self.answer_cache.enabled:
+            return None
+        prepared["query_vector"] = asyncio.ensure_future(self._embed_query(prepared["query"]))
+
+        cached_answer = None
+        if self.answer_cache.has_answers(prepared["customer_id"], prepared["knowledge_fingerprint"]):
+            cached_answer = self.answer_cache.lookup(prepared["customer_id"], prepared["knowledge_fingerprint"], await prepared["query_vector"])
+        if cached_answer is None:
+            prepared["broken_query"] = asyncio.ensure_future(self._call_agent(QueryPreprocessingAgent, "break_query", prepared["query"]))
+        return cached_answer
+
+    # a failure to cache the answer never fails the query
+    async def _store_answer(self, prepared, paragraph, response_code, images):
+        if not self.answer_cache.enabled:
+            return
+        try:
+            query_vector = await prepared["query_vector"]
+        except Exception as e:
+            print(f"[SEMANTIC ANSWER CACHE:ERROR] QUERY EMBEDDING FAILED, ANSWER NOT CACHED : {e}")
+            return
+        self.answer_cache.store(
+            prepared["customer_id"],
+            prepared["knowledge_fingerprint"],
+            prepared["cache_generation"],
+            prepared["query"],
+            query_vector,
+            paragraph,
+            response_code,
+            images,
+            time.monotonic() - prepared["started_at"]
+        )
+
+    async def query(self, body):
+        try:
+            prepared = await self._prepare_query(body)
+            customer_id = prepared["customer_id"]
+            user_id = prepared["user_id"]
+            query = prepared["query"]
+            query_response_codes = prepared["query_response_codes"]
+
+            cached_answer = await self._lookup_answer(prepared)
+            if cached_answer is not None:
+                chat_records = await self._run(self.chat_history_manager.append_many, customer_id, user_id, [
+                    ("user", "text", query),
+                    ("bot", "text", cached_answer["paragraph"]),
+                    *[("bot", "image", image) for image in cached_answer["images"]]
+                ])
+                return {
+                        "result":"true",
+                        "message":"success",
+                        "response":{
+                            "paragraph":chat_records[1],
+                            "images":chat_records[2:]
+                        },
+                        "response_code":cached_answer["response_code"]
+                    },200
+
+            # results are put back in sub-query order
+            sub_query_results = []
+            async for result in self._retrieve_for_query(prepared):
+                sub_query_results.append(result)
+            sub_query_results.sort(key=lambda result: result[0])
+
+            image_documents = [top_image_document for position, documents, top_image_document in sub_query_results if top_image_document is not None]
+            aggregate_context = self._build_context(customer_id, sub_query_results)
+            specific_response = await self._call_agent(QueryAnsweringAgent, "answer", query, aggregate_context)
+
+            pattern = r"^(" + "|".join(re.escape(match) for match in query_response_codes) + ")"
+            response_code = prepared["default_response_code"]
+            match = re.match(pattern, specific_response)
+            if match:
+                response_code = match.group(0)
+                specific_response = specific_response[match.end():].strip()
+
+            image_references = [self.get_image_reference(customer_id, d) for d in image_documents]
+            await self._store_answer(prepared, specific_response, response_code, image_references)
+
+            # the whole turn (query, answer and images) is persisted with a single write
+            chat_records = await self._run(self.chat_history_manager.append_many, customer_id, user_id, [
+                ("user", "text", query),
+                ("bot", "text", specific_response),
+                *[("bot", "image", image) for image in image_references]
+            ])
+            text_block = chat_records[1]
+            images_array = chat_records[2:]
+
+            return {
+                    "result":"true",
+                    "message":"success",
+                    "response":{
+                        "paragraph":text_block,
+                        "images":images_array
+                    },
+                    "response_code":response_code
+                },200
+        except Exception as e:
+            print(e)
+            return {
+                "result":"false",
+                "message":str(e)
+            },200
+
+    # streaming variant of query(), yields (event, data) pairs:
+    #   image          an image chat record, as soon as its sub-query's relevancy check passed
+    #   response_code  detected from the first tokens of the answer, before any token is sent
+    #   token          {"content": ...} answer text as it is generated, without the response code
+    #   done           the same payload query() returns, sent once the turn has been persisted
+    #   error          {"result": "false", "message": ...}
+    async def query_stream(self, body):
+        try:
+            prepared = await self._prepare_query(body)
+            customer_id = prepared["customer_id"]
+            user_id = prepared["user_id"]
+            query = prepared["query"]
+
+            cached_answer = await self._lookup_answer(prepared)
+            if cached_answer is not None:
+                async for event, data in self._stream_cached_answer(prepared, cached_answer):
+                    yield event, data
+                return
+
+            sub_query_results = []
+            images_array = []
+            async for position, documents, top_image_document in self._retrieve_for_query(prepared):
+                sub_query_results.append((position, documents, top_image_document))
+                if top_image_document is not None:
+                    image_record = self.chat_history_manager.create_record("bot", "image", self.get_image_reference(customer_id, top_image_document))
+                    images_array.append(image_record)
+                    yield "image", image_record
+            sub_query_results.sort(key=lambda result: result[0])
+
+            aggregate_context = self._build_context(customer_id, sub_query_results)
+
+            response_code_detector = ResponseCodeDetector(prepared["query_response_codes"], prepared["default_response_code"])
+            response_parts = []
+            async for token in self._stream_agent(QueryAnsweringAgent, "stream", query, aggregate_context):
+                for event, data in response_code_detector.feed(token):
+                    if event == "token":
+                        response_parts.append(data["content"])
+                    yield event, data
+            for event, data in response_code_detector.finish():
+                if event == "token":
+                    response_parts.append(data["content"])
+                yield event, data
+
+            paragraph = "".join(response_parts).strip()
+            await self._store_answer(prepared, paragraph, response_code_detector.response_code, [record["content"] for record in images_array])
+
+            # the whole turn is persisted with a single write once the answer is complete
+            text_block = self.chat_history_manager.create_record("bot", "text", paragraph)
+            await self._run(self.chat_history_manager.append_records, customer_id, user_id, [
+                self.chat_history_manager.create_record("user", "text", query),
+                text_block,
+                *images_array
+            ])
+
+            yield "done", {
+                "result":"true",
+                "message":"success",
+                "response":{
+                    "paragraph":text_block,
+                    "images":images_array
+                },
+                "response_code":response_code_detector.response_code
+            }
+        except Exception as e:
+            print(e)
+            yield "error", {
+                "result":"false",
+                "message":str(e)
+            }
+
+    # replays a cached answer with the events of a generated one, the paragraph as a single token
+    async def _stream_cached_answer(self, prepared, cached_answer):
+        images_array = []
+        for image in cached_answer["images"]:
+            image_record = self.chat_history_manager.create_record("bot", "image", image)
+            images_array.append(image_record)
+            yield "image", image_record
+        yield "response_code", {"response_code": cached_answer["response_code"]}
+        if cached_answer["paragraph"]:
+            yield "token", {"content": cached_answer["paragraph"]}
+
+        text_block = self.chat_history_manager.create_record("bot", "text", cached_answer["paragraph"])
+        await self._run(self.chat_history_manager.append_records, prepared["customer_id"], prepared["user_id"], [
+            self.chat_history_manager.create_record("user", "text", prepared["query"]),
+            text_block,
+            *images_array
+        ])
+
+        yield "done", {
+            "result":"true",
+            "message":"success",
+            "response":{
+                "paragraph":text_block,
+                "images":images_array
+            },
+            "response_code":cached_answer["response_code"]
+        }
+
+    # streams the tokens of a streaming agent method, its async counterpart is named with an "a" prefix.
+    # without native_async the blocking stream is consumed in a thread and handed over through a queue
+    async def _stream_agent(self, agent_class, agent_method, *args):
+        agent = agent_registry.get(agent_class)
+        if self.native_async:
+            async for token in getattr(agent, f"a{agent_method}")(*args):
+                yield token
+            return
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        finished = object()
+        cancelled = threading.Event()
+
+        def produce():
+            try:
+                for token in getattr(agent, agent_method)(*args):
+                    if cancelled.is_set():
+                        return
+                    loop.call_soon_threadsafe(queue.put_nowait, token)
+                loop.call_soon_threadsafe(queue.put_nowait, finished)
+            except Exception as e:
+                if not cancelled.is_set():
+                    loop.call_soon_threadsafe(queue.put_nowait, e)
+
+        producer = loop.run_in_executor(None, produce)
+        try:
+            while True:
+                item = await queue.get()
+                if item is finished:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # the client went away or the stream failed, stop the producer at its next token
+            cancelled.set()
+            await asyncio.wait([producer])
+
+    async def upload(self, body):
+        try:
+            artifacts = body.get("artifacts")
+            customer_id = body.get("customer_id")
+
+            customer_config = await self._run(self.rm.get, f'customer_config/{customer_id}')
+            if not customer_config:
+                raise Exception("customer config not found. maybe customer doesnt exist. use /config endpoint to create customer config")
+
+            if not artifacts:
+                raise Exception("no artifacts provided")
+
+            # artifacts are downloaded, parsed, summarized and embedded by the ingestion workers
+            job_id = await self._run(self.ingestion_job_queue.submit, customer_id, artifacts)
+
+            return {
+                    "result":"true",
+                    "message":f"{len(artifacts)} artifacts queued",
+                    "job_id":job_id
+                },202
+        except Exception as e:
+            return {
+                "result":"false",
+                "message":str(e)
+            },400
+
+    async def upload_status(self, job_id):
+        job = await self._run(self.ingestion_job_queue.get_job, job_id)
+        if job is None:
+            return {
+                "result":"false",
+                "message":"job not found"
+            },404
+
+        return {
+            "result":"true",
+            "message":job["status"],
+            "job":job
+        },200
+
+    async def delete(self, body):
+        try:
+            print("DELETING ARTIFACTS")
+
+            customer_id = body.get("customer_id")
+            artifact_ids = body.get("artifacts")
+            no_of_artifacts = len(artifact_ids)
+
+            await self._run(self._delete_artifacts, customer_id, artifact_ids)
+
+            return {
+                "result":"true",
+                "message": f"{no_of_artifacts} artifacts deleted"
+            },200
+        except Exception as e:
+            print(str(e))
+            return {
+                "result":"false",
+                "message":"invalid request"
+            },400
+
+    def _delete_artifacts(self, customer_id, artifact_ids):
+        # deleting document chunks from the vector store
+        self.vsi.delete(f"{customer_id}_vector_store","metadata.artifact_id",artifact_ids)
+        self.vsi.delete(f"{customer_id}_image_vector_store","metadata.artifact_id",artifact_ids)
+
+        # a deleted artifact uploaded again has to be ingested again, even if it did not change
+        self.knowledge_ingestor.artifact_downloader.forget(customer_id, artifact_ids)
+
+        # deleting corresponding knowledge summaries and updating the knowledge digest
+        self.knowledge_ingestor.remove_knowledge_summaries(customer_id, artifact_ids)
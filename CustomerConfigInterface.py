@@ -18,11 +18,16 @@
 #         print(f"database write config {id}")
 #         self.collection.replace_one({"customer_id": id}, value, upsert=True)
        
-from pymongo import MongoClient
+from MongoConnectionManager import mongo_connection_manager
 
 class CustomerConfigInterface():
     def __init__(self, db_url=None):
-        self.collection = MongoClient(db_url)["toofan_local"]["customer_configs"]
+        self.db_url = db_url
+
+    # resolved on every use so the shared client can be replaced after a fork
+    @property
+    def collection(self):
+        return mongo_connection_manager.get_client(self.db_url)["toofan_local"]["customer_configs"]
 
     def read(self, id):
         print(f"[CUSTOMER CONFIG INTERFACE] READING CUSTOMER CONFIG {id}")
@@ -0,0 +1,131 @@
+import asyncio
+import hashlib
+import threading
+from cachetools import LRUCache
+from diskcache import Cache
+
+# content addressed cache in front of an embedder.
+# entries are keyed by a hash of the model name, the embedding kind (query or document,
+# since they are embedded with different task types) and the text itself.
+# tier 1 is an in-process lru, tier 2 is an optional size bounded on-disk cache.
+class CachedEmbedder:
+    def __init__(self, embedder, model_name, cache_size = 10000, disk_cache_directory = None, disk_cache_size_limit = 2**30):
+        self.embedder = embedder
+        self.model_name = model_name
+
+        self.lock = threading.Lock()
+        self.memory_cache = LRUCache(maxsize=cache_size)
+        self.disk_cache = None
+        if disk_cache_directory:
+            self.disk_cache = Cache(disk_cache_directory, size_limit=disk_cache_size_limit, eviction_policy="least-recently-used")
+
+        self.stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0
+        }
+
+    def get_key(self, kind, text):
+        return hashlib.sha256(f"{self.model_name}\0{kind}\0{text}".encode("utf-8")).hexdigest()
+
+    def _lookup(self, key):
+        vector = self._lookup_memory(key)
+        if vector is None:
+            vector = self._lookup_disk(key)
+        return vector
+
+    def _lookup_memory(self, key):
+        with self.lock:
+            vector = self.memory_cache.get(key)
+            if vector is not None:
+                self.stats["memory_hits"] += 1
+            return vector
+
+    # counts the miss of both tiers when the disk tier does not have it either
+    def _lookup_disk(self, key):
+        if self.disk_cache is not None:
+            vector = self.disk_cache.get(key)
+            if vector is not None:
+                with self.lock:
+                    self.stats["disk_hits"] += 1
+                    self.memory_cache[key] = vector
+                return vector
+
+        with self.lock:
+            self.stats["misses"] += 1
+        return None
+
+    def _store(self, key, vector):
+        vector = self._store_memory(key, vector)
+        if self.disk_cache is not None:
+            self.disk_cache.set(key, vector)
+
+    def _store_memory(self, key, vector):
+        vector = list(vector)
+        with self.lock:
+            self.memory_cache[key] = vector
+        return vector
+
+    def embed_query(self, text):
+        key = self.get_key("query", text)
+        vector = self._lookup(key)
+        if vector is None:
+            vector = self.embedder.embed_query(text)
+            self._store(key, vector)
+        return vector
+
+    # only the in-memory tier is used on the event loop, the disk tier is read and written in threads
+    async def aembed_query(self, text):
+        key = self.get_key("query", text)
+        vector = self._lookup_memory(key)
+        if vector is not None:
+            return vector
+        if self.disk_cache is not None:
+            vector = await asyncio.to_thread(self._lookup_disk, key)
+        else:
+            vector = self._lookup_disk(key)
+        if vector is None:
+            vector = await self.embedder.aembed_query(text)
+            vector = self._store_memory(key, vector)
+            if self.disk_cache is not None:
+                await asyncio.to_thread(self.disk_cache.set, key, vector)
+        return vector
+
+    def embed_documents(self, texts):
+        texts = list(texts)
+        vectors = [None] * len(texts)
+
+        # identical texts within one call are embedded once
+        missing = {}
+        for i, text in enumerate(texts):
+            key = self.get_key("document", text)
+            if key in missing:
+                missing[key].append(i)
+                continue
+            vector = self._lookup(key)
+            if vector is None:
+                missing[key] = [i]
+            else:
+                vectors[i] = vector
+
+        if len(missing) != 0:
+            print(f"[EMBEDDING CACHE] {len(missing)} OF {len(texts)} TEXTS NOT CACHED, EMBEDDING")
+            keys = list(missing)
+            embedded = self.embedder.embed_documents([texts[missing[key][0]] for key in keys])
+            for key, vector in zip(keys, embedded):
+                self._store(key, vector)
+                for i in missing[key]:
+                    vectors[i] = vector
+
+        return vectors
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["memory_entries"] = len(self.memory_cache)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_ratio"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        if self.disk_cache is not None:
+            stats["disk_entries"] = len(self.disk_cache)
+            stats["disk_bytes"] = self.disk_cache.volume()
+        return stats
@@ -0,0 +1,263 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from uuid import uuid4
+
+IN_PROGRESS_STATUSES = ("pending", "downloading", "downloaded", "running")
+
+# sqlite backed job queue for knowledge ingestion, no external broker required.
+# a job is one POST /knowledge request, every artifact of a job is queued and processed
+# separately by a pool of worker threads. workers always pick the customer that was served
+# least recently, so one customer uploading hundreds of artifacts cannot starve the others.
+# several processes can share the queue: an artifact is claimed with a lease of lease_duration
+# seconds that its owner renews while processing it. only artifacts whose lease expired (their
+# process crashed or was stopped) are picked up again, never those of a live process.
+# with a downloader, artifacts are first downloaded by their own pool of num_download_workers
+# (pending -> downloading -> downloaded) so that downloads run ahead of, and are not bounded by,
+# the ingestion workers (downloaded -> running -> completed).
+class IngestionJobQueue:
+    def __init__(self, processor, database_path = "database/environment/ingestion_queue.db", num_workers = 4, poll_interval = 2, lease_duration = 60, downloader = None, num_download_workers = 8):
+        # processor(customer_id, artifact, report_progress) -> status string. with a downloader,
+        # artifact["download"] is what the downloader returned
+        self.processor = processor
+        # downloader(customer_id, artifact, report_progress) -> json serializable download, or None when there is nothing to ingest
+        self.downloader = downloader
+        self.num_download_workers = num_download_workers if downloader is not None else 0
+        self.database_path = database_path
+        self.num_workers = num_workers
+        self.poll_interval = poll_interval
+        self.lease_duration = lease_duration
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid4()}"
+
+        self.workers = []
+        self.heartbeat = None
+        self.wake_up = threading.Condition()
+        self.stopping = False
+
+        Path(os.path.dirname(database_path) or '.').mkdir(parents=True, exist_ok=True)
+        self._create_tables()
+
+    # autocommit connection, multi statement writes open their own transaction.
+    # closing the connection rolls back a transaction left open by an exception.
+    @contextmanager
+    def _connect(self):
+        connection = sqlite3.connect(self.database_path, timeout=30, isolation_level=None)
+        try:
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            yield connection
+        finally:
+            connection.close()
+
+    def _create_tables(self):
+        with self._connect() as connection:
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    customer_id TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS artifacts (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    job_id TEXT NOT NULL,
+                    customer_id TEXT NOT NULL,
+                    artifact_id TEXT,
+                    artifact_url TEXT,
+                    status TEXT NOT NULL,
+                    stage TEXT,
+                    error TEXT,
+                    owner TEXT,
+                    lease_expires_at REAL,
+                    download TEXT,
+                    updated_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS artifacts_job_id ON artifacts (job_id);
+                CREATE INDEX IF NOT EXISTS artifacts_status ON artifacts (status);
+                CREATE TABLE IF NOT EXISTS customers (
+                    customer_id TEXT PRIMARY KEY,
+                    last_served_at REAL NOT NULL
+                );
+            """)
+            # queues created before leases existed
+            columns = {column["name"] for column in connection.execute("PRAGMA table_info(artifacts)")}
+            for column, type in (("owner", "TEXT"), ("lease_expires_at", "REAL"), ("download", "TEXT")):
+                if column not in columns:
+                    connection.execute(f"ALTER TABLE artifacts ADD COLUMN {column} {type}")
+
+    def start(self):
+        for i in range(self.num_workers):
+            worker = threading.Thread(target=self._work, name=f"ingestion-worker-{i}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        for i in range(self.num_download_workers):
+            worker = threading.Thread(target=self._download, name=f"download-worker-{i}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        self.heartbeat = threading.Thread(target=self._renew_leases, name="ingestion-heartbeat", daemon=True)
+        self.heartbeat.start()
+        print(f"[INGESTION JOB QUEUE] STARTED {self.num_workers} INGESTION AND {self.num_download_workers} DOWNLOAD WORKERS AS {self.owner}")
+
+    def stop(self):
+        with self.wake_up:
+            self.stopping = True
+            self.wake_up.notify_all()
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        if self.heartbeat is not None:
+            self.heartbeat.join()
+            self.heartbeat = None
+
+    def submit(self, customer_id, artifacts):
+        job_id = str(uuid4())
+        now = time.time()
+        customer_id = str(customer_id)
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute("INSERT INTO jobs (job_id, customer_id, created_at) VALUES (?, ?, ?)", (job_id, customer_id, now))
+            connection.executemany(
+                "INSERT INTO artifacts (job_id, customer_id, artifact_id, artifact_url, status, updated_at) VALUES (?, ?, ?, ?, 'pending', ?)",
+                [(job_id, customer_id, a.get("artifact_id"), a.get("artifact_url"), now) for a in artifacts]
+            )
+            connection.execute("COMMIT")
+
+        print(f"[INGESTION JOB QUEUE] JOB {job_id} QUEUED WITH {len(artifacts)} ARTIFACTS FOR CUSTOMER {customer_id}")
+        with self.wake_up:
+            self.wake_up.notify_all()
+        return job_id
+
+    def get_job(self, job_id):
+        with self._connect() as connection:
+            job = connection.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if job is None:
+                return None
+            artifacts = connection.execute(
+                "SELECT artifact_id, artifact_url, status, stage, error, updated_at FROM artifacts WHERE job_id = ? ORDER BY id",
+                (job_id,)
+            ).fetchall()
+
+        artifacts = [dict(a) for a in artifacts]
+        statuses = [a["status"] for a in artifacts]
+        if any(s in IN_PROGRESS_STATUSES for s in statuses):
+            status = "running" if any(s != "pending" for s in statuses) else "pending"
+        elif "failed" in statuses:
+            status = "completed_with_errors"
+        else:
+            status = "completed"
+
+        return {
+            "job_id": job["job_id"],
+            "customer_id": job["customer_id"],
+            "created_at": job["created_at"],
+            "status": status,
+            "total": len(artifacts),
+            "finished": sum(1 for s in statuses if s not in IN_PROGRESS_STATUSES),
+            "artifacts": artifacts
+        }
+
+    # claims the next artifact waiting in status (or one left in claimed_status by an owner whose lease expired)
+    # and moves it to claimed_status. reclaimed tells the processor that a previous attempt may have left
+    # partial results behind
+    def _claim(self, status, claimed_status):
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            artifact = connection.execute("""
+                SELECT a.id, a.job_id, a.customer_id, a.artifact_id, a.artifact_url, a.status, a.owner, a.download
+                FROM artifacts a LEFT JOIN customers c ON c.customer_id = a.customer_id
+                WHERE a.status = ? OR (a.status = ? AND COALESCE(a.lease_expires_at, 0) < ?)
+                ORDER BY COALESCE(c.last_served_at, 0), a.id
+                LIMIT 1
+            """, (status, claimed_status, now)).fetchone()
+            if artifact is None:
+                connection.execute("COMMIT")
+                return None
+            connection.execute(
+                "UPDATE artifacts SET status = ?, stage = 'starting', owner = ?, lease_expires_at = ?, updated_at = ? WHERE id = ?",
+                (claimed_status, self.owner, now + self.lease_duration, now, artifact["id"])
+            )
+            connection.execute("INSERT OR REPLACE INTO customers (customer_id, last_served_at) VALUES (?, ?)", (artifact["customer_id"], now))
+            connection.execute("COMMIT")
+
+        if artifact["status"] == claimed_status:
+            print(f"[INGESTION JOB QUEUE] LEASE OF {artifact['owner']} EXPIRED, RECLAIMED ARTIFACT {artifact['artifact_id']} OF JOB {artifact['job_id']}")
+        reclaimed = artifact["status"] == claimed_status
+        artifact = dict(artifact)
+        artifact["download"] = json.loads(artifact["download"]) if artifact["download"] else None
+        artifact["reclaimed"] = reclaimed
+        return artifact
+
+    # only the current owner of the lease may update an artifact, a worker that lost its lease
+    # (e.g. stalled past lease_duration) must not overwrite the progress of the one that reclaimed it
+    def _update(self, id, **fields):
+        fields["updated_at"] = time.time()
+        assignments = ", ".join(f"{key} = ?" for key in fields)
+        with self._connect() as connection:
+            updated = connection.execute(f"UPDATE artifacts SET {assignments} WHERE id = ? AND owner = ?", (*fields.values(), id, self.owner)).rowcount
+        if not updated:
+            print(f"[INGESTION JOB QUEUE:ERROR] LEASE OF ARTIFACT {id} WAS LOST, UPDATE DISCARDED")
+
+    # renews the leases of every artifact this process is working on, several times per lease_duration
+    def _renew_leases(self):
+        while True:
+            with self.wake_up:
+                if not self.stopping:
+                    self.wake_up.wait(self.lease_duration / 3)
+                if self.stopping:
+                    return
+            try:
+                with self._connect() as connection:
+                    connection.execute(
+                        "UPDATE artifacts SET lease_expires_at = ? WHERE owner = ? AND status IN ('running', 'downloading')",
+                        (time.time() + self.lease_duration, self.owner)
+                    )
+            except Exception as e:
+                print(f"[INGESTION JOB QUEUE:ERROR] RENEWING LEASES FAILED : {e}")
+
+    def _wait(self):
+        with self.wake_up:
+            if not self.stopping:
+                self.wake_up.wait(self.poll_interval)
+
+    def _work(self):
+        while not self.stopping:
+            # without a downloader the ingestion workers take pending artifacts directly
+            artifact = self._claim("downloaded" if self.downloader is not None else "pending", "running")
+            if artifact is None:
+                self._wait()
+                continue
+
+            id = artifact["id"]
+            report_progress = lambda stage: self._update(id, stage=stage)
+            try:
+                status = self.processor(artifact["customer_id"], artifact, report_progress)
+                self._update(id, status=status or "completed", stage=None, lease_expires_at=None)
+            except Exception as e:
+                print(f"[INGESTION JOB QUEUE:ERROR] ARTIFACT {artifact['artifact_id']} OF JOB {artifact['job_id']} FAILED : {e}")
+                self._update(id, status="failed", stage=None, lease_expires_at=None, error=str(e))
+
+    def _download(self):
+        while not self.stopping:
+            artifact = self._claim("pending", "downloading")
+            if artifact is None:
+                self._wait()
+                continue
+
+            id = artifact["id"]
+            report_progress = lambda stage: self._update(id, stage=stage)
+            try:
+                download = self.downloader(artifact["customer_id"], artifact, report_progress)
+                if download is None:
+                    self._update(id, status="unchanged", stage=None, lease_expires_at=None)
+                    continue
+                self._update(id, status="downloaded", stage=None, lease_expires_at=None, download=json.dumps(download))
+                with self.wake_up:
+                    self.wake_up.notify_all()
+            except Exception as e:
+                print(f"[INGESTION JOB QUEUE:ERROR] DOWNLOADING ARTIFACT {artifact['artifact_id']} OF JOB {artifact['job_id']} FAILED : {e}")
+                self._update(id, status="failed", stage=None, lease_expires_at=None, error=str(e))
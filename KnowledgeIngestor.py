@@ -0,0 +1,272 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from ArtifactDownloader import ArtifactDownloader
+from rag import KnowledgeArtifactLoader, LangchainDocumentsSplitter
+from agents import SummarizingAgent, estimate_tokens
+from AgentRegistry import agent_registry
+
+# downloads, parses, summarizes and embeds a single knowledge artifact for a customer.
+# runs on the ingestion workers, so several artifacts (of the same or different customers)
+# can be ingested at the same time.
+class KnowledgeIngestor:
+    def __init__(self, resource_manager = None, vector_store_manager = None, artifact_downloader = None, answer_cache = None, knowledge_digest_token_budget = 2000):
+        self.resource_manager = resource_manager
+        self.vector_store_manager = vector_store_manager
+        self.artifact_downloader = artifact_downloader or ArtifactDownloader()
+        self.answer_cache = answer_cache
+        self.knowledge_digest_token_budget = knowledge_digest_token_budget
+        self.customer_locks = {}
+        self.digest_locks = {}
+        self.customer_locks_lock = threading.Lock()
+        # digests too large to rebuild by joining summaries are re-summarized off the request path
+        self.digest_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="knowledge-digest")
+
+    # serializes read-modify-write cycles on a customer's config
+    def get_customer_lock(self, customer_id):
+        return self._get_lock(self.customer_locks, customer_id)
+
+    # serializes digest rebuilds of a customer. held across summarizer calls, so the config lock is not
+    def get_digest_lock(self, customer_id):
+        return self._get_lock(self.digest_locks, customer_id)
+
+    def _get_lock(self, locks, customer_id):
+        with self.customer_locks_lock:
+            lock = locks.get(customer_id)
+            if lock is None:
+                lock = threading.Lock()
+                locks[customer_id] = lock
+            return lock
+
+    # the knowledge digest is the customer's knowledge summaries compressed to knowledge_digest_token_budget
+    # tokens, stored in the customer config as {"text", "artifact_ids"} so the query path reads one string.
+    # summaries are appended to it right away, once it outgrows the budget it is re-summarized on the
+    # digest executor. no summarizer call is made while a customer's config is locked.
+    def build_knowledge_digest(self, summaries):
+        text = "\n".join(summaries)
+        if self.exceeds_budget(text):
+            print(f"[KNOWLEDGE INGESTOR] RE-SUMMARIZING KNOWLEDGE DIGEST OF {len(summaries)} SUMMARIES")
+            summarizing_agent = agent_registry.get(SummarizingAgent)
+            text = summarizing_agent.reduce_summaries(summaries)
+            for attempt in range(2):
+                if not self.exceeds_budget(text):
+                    break
+                print(f"[KNOWLEDGE INGESTOR] KNOWLEDGE DIGEST STILL OVER BUDGET, RE-SUMMARIZING IT AGAIN")
+                text = summarizing_agent.reduce_summaries([text])
+            if self.exceeds_budget(text):
+                print(f"[KNOWLEDGE INGESTOR:ERROR] KNOWLEDGE DIGEST STILL OVER BUDGET, TRUNCATING IT")
+                text = text[:(self.knowledge_digest_token_budget - 1) * 4]
+        return text
+
+    def exceeds_budget(self, text):
+        return estimate_tokens(text) > self.knowledge_digest_token_budget
+
+    def get_knowledge_digest(self, customer_config):
+        knowledge_digest = customer_config.get("knowledge_digest")
+        if knowledge_digest is not None:
+            return knowledge_digest
+        # configs written before digests existed
+        knowledge_summaries = customer_config.get("knowledge_summaries") or []
+        return {
+            "text": "\n".join(ks["artifact_summary"] for ks in knowledge_summaries),
+            "artifact_ids": [ks["artifact_id"] for ks in knowledge_summaries]
+        }
+
+    # artifact_sha256 is the content hash of the ingested version, part of the answer cache's knowledge fingerprint
+    def add_knowledge_summary(self, customer_id, artifact_id, summary, artifact_sha256 = None):
+        with self.get_customer_lock(customer_id):
+            customer_config = self.resource_manager.get(f'customer_config/{customer_id}')
+            if not customer_config:
+                raise Exception("customer config not found. maybe customer doesnt exist. use /config endpoint to create customer config")
+            knowledge_digest = self.get_knowledge_digest(customer_config)
+            knowledge_digest = {
+                "text": "\n".join(s for s in (knowledge_digest["text"], summary) if s),
+                "artifact_ids": knowledge_digest["artifact_ids"] + [artifact_id]
+            }
+            customer_config["knowledge_summaries"].append({
+                "artifact_id":artifact_id,
+                "artifact_summary":summary,
+                "artifact_sha256":artifact_sha256
+            })
+            customer_config["knowledge_digest"] = knowledge_digest
+            self.resource_manager.set(f'customer_config/{customer_id}', customer_config)
+
+        if self.exceeds_budget(knowledge_digest["text"]):
+            self.digest_executor.submit(self.rebuild_knowledge_digest, customer_id)
+        # answers cached before this artifact was ingested may now be incomplete
+        if self.answer_cache is not None:
+            self.answer_cache.invalidate(customer_id)
+
+    # a summary cannot be taken back out of a compressed digest, so it is replaced by the remaining
+    # summaries joined together and re-summarized in the background when that is over budget.
+    def remove_knowledge_summaries(self, customer_id, artifact_ids):
+        with self.get_customer_lock(customer_id):
+            customer_config = self.resource_manager.get(f'customer_config/{customer_id}')
+            knowledge_summaries = [ks for ks in customer_config.get("knowledge_summaries") if ks["artifact_id"] not in artifact_ids]
+            customer_config["knowledge_summaries"] = knowledge_summaries
+
+            knowledge_digest = customer_config.get("knowledge_digest")
+            digest_is_stale = knowledge_digest is None or any(id in artifact_ids for id in knowledge_digest["artifact_ids"])
+            if digest_is_stale:
+                knowledge_digest = {
+                    "text": "\n".join(ks["artifact_summary"] for ks in knowledge_summaries),
+                    "artifact_ids": [ks["artifact_id"] for ks in knowledge_summaries]
+                }
+                customer_config["knowledge_digest"] = knowledge_digest
+            self.resource_manager.set(f'customer_config/{customer_id}', customer_config)
+
+        if digest_is_stale and self.exceeds_budget(knowledge_digest["text"]):
+            self.digest_executor.submit(self.rebuild_knowledge_digest, customer_id)
+        if self.answer_cache is not None:
+            self.answer_cache.invalidate(customer_id)
+
+    # summaries added while the summarizer runs are appended to the rebuilt digest, summaries removed
+    # meanwhile leave the digest to the rebuild their removal scheduled
+    def rebuild_knowledge_digest(self, customer_id):
+        try:
+            with self.get_digest_lock(customer_id):
+                customer_config = self.resource_manager.get(f'customer_config/{customer_id}')
+                if not customer_config:
+                    return
+                knowledge_digest = customer_config.get("knowledge_digest")
+                if knowledge_digest is not None and not self.exceeds_budget(knowledge_digest["text"]):
+                    return
+                knowledge_summaries = customer_config.get("knowledge_summaries") or []
+                artifact_ids = [ks["artifact_id"] for ks in knowledge_summaries]
+                text = self.build_knowledge_digest([ks["artifact_summary"] for ks in knowledge_summaries])
+
+                with self.get_customer_lock(customer_id):
+                    customer_config = self.resource_manager.get(f'customer_config/{customer_id}')
+                    if not customer_config:
+                        return
+                    knowledge_summaries = customer_config.get("knowledge_summaries") or []
+                    current_artifact_ids = {ks["artifact_id"] for ks in knowledge_summaries}
+                    if any(id not in current_artifact_ids for id in artifact_ids):
+                        return
+                    added_summaries = [ks for ks in knowledge_summaries if ks["artifact_id"] not in artifact_ids]
+                    knowledge_digest = {
+                        "text": "\n".join([text] + [ks["artifact_summary"] for ks in added_summaries]),
+                        "artifact_ids": artifact_ids + [ks["artifact_id"] for ks in added_summaries]
+                    }
+                    customer_config["knowledge_digest"] = knowledge_digest
+                    self.resource_manager.set(f'customer_config/{customer_id}', customer_config)
+            print(f"[KNOWLEDGE INGESTOR] KNOWLEDGE DIGEST REBUILT FOR CUSTOMER {customer_id}")
+            if self.exceeds_budget(knowledge_digest["text"]):
+                self.digest_executor.submit(self.rebuild_knowledge_digest, customer_id)
+            if self.answer_cache is not None:
+                self.answer_cache.invalidate(customer_id)
+        except Exception as e:
+            print(f"[KNOWLEDGE INGESTOR:ERROR] KNOWLEDGE DIGEST REBUILD FAILED FOR CUSTOMER {customer_id} : {e}")
+
+    # returns the download of the artifact, None when it was already ingested and did not change since
+    def download(self, customer_id, artifact, report_progress = None):
+        if report_progress is None:
+            report_progress = lambda stage: None
+
+        artifact_id = artifact.get("artifact_id")
+        print(f"[KNOWLEDGE INGESTOR] DOWNLOADING ARTIFACT {artifact_id} FOR CUSTOMER {customer_id}")
+        # ensuring the required folder exists
+        knowledge_base_path = f'database/services/{customer_id}/knowledge_base'
+        os.makedirs(knowledge_base_path, exist_ok=True)
+
+        report_progress("downloading")
+        download = self.artifact_downloader.download(customer_id, artifact_id, artifact.get("artifact_url"), knowledge_base_path)
+        if download["status"] != "downloaded":
+            return None
+        return download
+
+    # removes the chunks, image descriptions and knowledge summaries of the artifacts
+    def remove_artifact_knowledge(self, customer_id, artifact_ids):
+        self.vector_store_manager.delete(f"{customer_id}_vector_store", "metadata.artifact_id", artifact_ids, validate_field=False)
+        self.vector_store_manager.delete(f"{customer_id}_image_vector_store", "metadata.artifact_id", artifact_ids, validate_field=False)
+        self.remove_knowledge_summaries(customer_id, artifact_ids)
+
+    def ingest(self, customer_id, artifact, report_progress = None):
+        if report_progress is None:
+            report_progress = lambda stage: None
+
+        artifact_id = artifact.get("artifact_id")
+
+        # downloaded ahead by the download workers of the job queue, or here
+        download = artifact.get("download")
+        if download is None:
+            download = self.download(customer_id, artifact, report_progress)
+            if download is None:
+                return "unchanged"
+
+        print(f"[KNOWLEDGE INGESTOR] INGESTING ARTIFACT {artifact_id} FOR CUSTOMER {customer_id}")
+
+        # we can delete the file after embeddings have been created.
+        system_config = self.resource_manager.get("file_system/database/environment/config.json")
+        persist_uploaded_files = system_config["persist_uploaded_files"]
+
+        # a changed artifact replaces what was ingested from its previous version
+        if download.get("previously_ingested"):
+            report_progress("removing previous version")
+            self.remove_artifact_knowledge(customer_id, [artifact_id])
+        # a worker whose lease expired may have embedded or summarized part of the artifact already
+        elif artifact.get("reclaimed"):
+            report_progress("removing partial ingestion")
+            self.remove_artifact_knowledge(customer_id, [artifact_id])
+
+        download_path = download["path"]
+        extension = download["extension"]
+
+        loader = agent_registry.get(
+            KnowledgeArtifactLoader,
+            resource_manager=self.resource_manager,
+            image_min_dimension=system_config.get("pdf_image_min_dimension", 64),
+            image_min_bytes=system_config.get("pdf_image_min_bytes", 2048),
+            image_description_workers=system_config.get("image_description_workers", 4)
+        )
+        summarizer = agent_registry.get(SummarizingAgent)
+        path = download_path
+
+        # pdfs are streamed page -> chunk -> embedding batch -> bulk insert. the pdf is parsed once
+        # for summarization and once for embedding so neither pass needs every page in memory
+        if extension and extension.lower() == ".pdf":
+            report_progress("summarizing")
+            summary = summarizer.summarize_from_documents(loader.lazy_load_pdf(path, artifact_id))
+            report_progress("describing images")
+            image_descriptions = loader.load_images_from_pdf(path, artifact_id)
+            report_progress("embedding")
+            chunks = LangchainDocumentsSplitter().lazy_split(loader.lazy_load_pdf(path, artifact_id))
+            self.vector_store_manager.embed(f'{customer_id}_vector_store',chunks)
+            self.vector_store_manager.embed(f'{customer_id}_image_vector_store',image_descriptions)
+            self.add_knowledge_summary(customer_id, artifact_id, summary, download["sha256"])
+            self.artifact_downloader.commit(customer_id, artifact_id, download)
+            if not persist_uploaded_files:
+                os.remove(path)
+            return "completed"
+
+        if extension and extension.lower() == ".txt":
+            report_progress("parsing")
+            pages = loader.load_text(path, artifact_id)
+            report_progress("summarizing")
+            summary = summarizer.summarize_from_documents(pages)
+            report_progress("embedding")
+            chunks = LangchainDocumentsSplitter().split(pages)
+            self.vector_store_manager.embed(f'{customer_id}_vector_store',chunks)
+            self.add_knowledge_summary(customer_id, artifact_id, summary, download["sha256"])
+            self.artifact_downloader.commit(customer_id, artifact_id, download)
+            if not persist_uploaded_files:
+                os.remove(path)
+            return "completed"
+
+        if extension and extension.lower() in (".png", ".jpg", ".jpeg"):
+            report_progress("describing images")
+            path = loader.store_image_file(path)
+            image_descriptions = loader.load_image(path, artifact_id)
+            report_progress("summarizing")
+            summary = summarizer.summarize_from_documents(image_descriptions)
+            report_progress("embedding")
+            self.vector_store_manager.embed(f'{customer_id}_image_vector_store',image_descriptions)
+            self.add_knowledge_summary(customer_id, artifact_id, summary, download["sha256"])
+            self.artifact_downloader.commit(customer_id, artifact_id, download)
+            # images shall not be removed as they are required during retrieval with allow_multimodal_for_images
+            return "completed"
+
+        print(f"[KNOWLEDGE INGESTOR] UNSUPPORTED ARTIFACT TYPE {extension}, SKIPPING : {artifact_id}")
+        os.remove(download_path)
+        return "skipped"
@@ -0,0 +1,98 @@
+import heapq
+import math
+import re
+import threading
+from collections import Counter
+
+# compound tokens such as part numbers (ab-1234), error codes (e.404) or clause ids (4.2.1) are kept
+# whole and additionally indexed by their parts, so both "ab-1234" and "1234" find the chunk
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[-_./:#][a-z0-9]+)*")
+TOKEN_SEPARATOR_PATTERN = re.compile(r"[-_./:#]")
+
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "has", "have", "how", "i", "in", "is", "it",
+    "its", "of", "on", "or", "that", "the", "this", "to", "was", "were", "what", "when", "where", "which", "who",
+    "why", "will", "with", "you", "your", "do", "does", "can"
+}
+
+def tokenize(text):
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        tokens.append(token)
+        parts = TOKEN_SEPARATOR_PATTERN.split(token)
+        if len(parts) > 1:
+            tokens.extend(part for part in parts if part not in STOPWORDS)
+    return tokens
+
+# in-memory bm25 inverted index over the chunks of a single vector store (mongo collection),
+# maintained next to its VectorIndex. only term frequencies are kept, not the texts.
+class LexicalIndex:
+    def __init__(self, k1 = 1.5, b = 0.75):
+        self.k1 = k1
+        self.b = b
+
+        self.lock = threading.RLock()
+        # id -> Counter of terms
+        self.documents = {}
+        # id -> number of terms
+        self.lengths = {}
+        # term -> set of ids
+        self.postings = {}
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.documents)
+
+    def add(self, ids, texts):
+        with self.lock:
+            # re-adding an existing id replaces its text
+            self.remove([id for id in ids if id in self.documents])
+
+            for id, text in zip(ids, texts):
+                term_frequencies = Counter(tokenize(text))
+                self.documents[id] = term_frequencies
+                self.lengths[id] = sum(term_frequencies.values())
+                self.total_length += self.lengths[id]
+                for term in term_frequencies:
+                    self.postings.setdefault(term, set()).add(id)
+
+    def remove(self, ids):
+        with self.lock:
+            for id in ids:
+                term_frequencies = self.documents.pop(id, None)
+                if term_frequencies is None:
+                    continue
+                self.total_length -= self.lengths.pop(id)
+                for term in term_frequencies:
+                    posting = self.postings.get(term)
+                    if posting is None:
+                        continue
+                    posting.discard(id)
+                    if len(posting) == 0:
+                        del self.postings[term]
+
+    # returns [(id, bm25 score)] of the k best matching chunks, best first. chunks sharing no term
+    # with the query are never returned, so fewer than k results is common
+    def search(self, query, k = 5):
+        query_terms = set(tokenize(query))
+
+        with self.lock:
+            number_of_documents = len(self.documents)
+            if number_of_documents == 0 or len(query_terms) == 0:
+                return []
+            average_length = self.total_length / number_of_documents
+
+            scores = {}
+            for term in query_terms:
+                posting = self.postings.get(term)
+                if not posting:
+                    continue
+                idf = math.log(1 + (number_of_documents - len(posting) + 0.5) / (len(posting) + 0.5))
+                for id in posting:
+                    tf = self.documents[id][term]
+                    length = self.lengths[id]
+                    scores[id] = scores.get(id, 0.0) + idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * length / average_length))
+
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
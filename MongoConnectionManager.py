@@ -0,0 +1,165 @@
+import os
+import threading
+from pymongo import MongoClient, monitoring
+from motor.motor_asyncio import AsyncIOMotorClient
+
+# counts connection pool events across every client created by the connection manager
+class ConnectionPoolMetrics(monitoring.ConnectionPoolListener):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {
+                "checked_out": 0,
+                "max_checked_out": 0,
+                "waiting": 0,
+                "max_waiting": 0,
+                "checkouts": 0,
+                "checkout_failures": 0,
+                "checkout_timeouts": 0,
+                "connections_open": 0,
+                "connections_created": 0,
+                "connections_closed": 0,
+                "pools_cleared": 0
+            }
+
+    def _increment(self, name, amount = 1):
+        with self.lock:
+            self.counters[name] += amount
+            if name == "checked_out":
+                self.counters["max_checked_out"] = max(self.counters["max_checked_out"], self.counters["checked_out"])
+            if name == "waiting":
+                self.counters["max_waiting"] = max(self.counters["max_waiting"], self.counters["waiting"])
+
+    def get(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._increment("pools_cleared")
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._increment("connections_created")
+        self._increment("connections_open")
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._increment("connections_closed")
+        self._increment("connections_open", -1)
+
+    def connection_check_out_started(self, event):
+        self._increment("waiting")
+
+    def connection_check_out_failed(self, event):
+        self._increment("waiting", -1)
+        self._increment("checkout_failures")
+        if event.reason == monitoring.ConnectionCheckOutFailedReason.TIMEOUT:
+            self._increment("checkout_timeouts")
+
+    def connection_checked_out(self, event):
+        self._increment("waiting", -1)
+        self._increment("checkouts")
+        self._increment("checked_out")
+
+    def connection_checked_in(self, event):
+        self._increment("checked_out", -1)
+
+# one pooled MongoClient per url for the whole process, shared by every mongo backed interface.
+# interfaces must ask for the client on use instead of holding on to it, so that reinit()
+# (run automatically in a forked child) can hand out fresh clients.
+# async (motor) clients bind to the event loop they are first used on, so they are only
+# handed out to code running on the asgi server's loop.
+class MongoConnectionManager:
+    def __init__(self, max_pool_size = 100, min_pool_size = 0, max_idle_time_ms = 60000, wait_queue_timeout_ms = 10000, server_selection_timeout_ms = 5000, connect_timeout_ms = 5000):
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.async_clients = {}
+        self.metrics = ConnectionPoolMetrics()
+        self.options = {}
+        self.configure(
+            max_pool_size = max_pool_size,
+            min_pool_size = min_pool_size,
+            max_idle_time_ms = max_idle_time_ms,
+            wait_queue_timeout_ms = wait_queue_timeout_ms,
+            server_selection_timeout_ms = server_selection_timeout_ms,
+            connect_timeout_ms = connect_timeout_ms
+        )
+
+    # only affects clients created afterwards
+    def configure(self, max_pool_size = None, min_pool_size = None, max_idle_time_ms = None, wait_queue_timeout_ms = None, server_selection_timeout_ms = None, connect_timeout_ms = None):
+        options = {
+            "maxPoolSize": max_pool_size,
+            "minPoolSize": min_pool_size,
+            "maxIdleTimeMS": max_idle_time_ms,
+            "waitQueueTimeoutMS": wait_queue_timeout_ms,
+            "serverSelectionTimeoutMS": server_selection_timeout_ms,
+            "connectTimeoutMS": connect_timeout_ms
+        }
+        with self.lock:
+            self.options.update({key: value for key, value in options.items() if value is not None})
+
+    def get_client(self, db_url):
+        client = self.clients.get(db_url)
+        if client is not None:
+            return client
+        with self.lock:
+            client = self.clients.get(db_url)
+            if client is None:
+                print(f"[MONGO CONNECTION MANAGER] CREATING CLIENT FOR {db_url}")
+                client = MongoClient(db_url, event_listeners=[self.metrics], **self.options)
+                self.clients[db_url] = client
+            return client
+
+    def get_async_client(self, db_url):
+        client = self.async_clients.get(db_url)
+        if client is not None:
+            return client
+        with self.lock:
+            client = self.async_clients.get(db_url)
+            if client is None:
+                print(f"[MONGO CONNECTION MANAGER] CREATING ASYNC CLIENT FOR {db_url}")
+                client = AsyncIOMotorClient(db_url, event_listeners=[self.metrics], **self.options)
+                self.async_clients[db_url] = client
+            return client
+
+    def get_metrics(self):
+        metrics = self.metrics.get()
+        with self.lock:
+            clients = len(self.clients) + len(self.async_clients)
+            capacity = self.options["maxPoolSize"] * clients
+        metrics["clients"] = clients
+        metrics["pool_capacity"] = capacity
+        metrics["pool_saturation"] = metrics["checked_out"] / capacity if capacity else 0.0
+        return metrics
+
+    # clients inherited from the parent process must not be used after a fork, drop them
+    # without closing (closing would tear down the parent's sockets) and start over
+    def reinit(self):
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.async_clients = {}
+        self.metrics.lock = threading.Lock()
+        self.metrics.reset()
+
+    def close(self):
+        with self.lock:
+            for client in [*self.clients.values(), *self.async_clients.values()]:
+                client.close()
+            self.clients = {}
+            self.async_clients = {}
+
+mongo_connection_manager = MongoConnectionManager()
+os.register_at_fork(after_in_child=mongo_connection_manager.reinit)
@@ -0,0 +1,64 @@
+import json
+import os
+import threading
+from langchain_core.prompts import PromptTemplate
+
+# local on-disk store for prompts that used to be pulled from the langchain hub on every call.
+# prompts live in {directory}/{owner}__{name}.json as {"name", "template", "input_variables"},
+# are all loaded at startup and served from memory afterwards.
+# a prompt missing on disk is pulled from the hub once and vendored for next time.
+class PromptStore:
+    def __init__(self, directory = "database/environment/prompts"):
+        self.directory = directory
+        self.prompts = {}
+        self.lock = threading.Lock()
+        self.load_all()
+
+    def get_path(self, name):
+        return os.path.join(self.directory, name.replace("/", "__") + ".json")
+
+    def load_all(self):
+        if not os.path.isdir(self.directory):
+            return
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".json"):
+                continue
+            with open(os.path.join(self.directory, filename), "r") as file:
+                record = json.load(file)
+            self.prompts[record["name"]] = PromptTemplate(template=record["template"], input_variables=record["input_variables"])
+        print(f"[PROMPT STORE] LOADED {len(self.prompts)} PROMPTS FROM {self.directory}")
+
+    def get(self, name):
+        prompt = self.prompts.get(name)
+        if prompt is not None:
+            return prompt
+
+        with self.lock:
+            prompt = self.prompts.get(name)
+            if prompt is None:
+                prompt = self.pull(name)
+                self.prompts[name] = prompt
+            return prompt
+
+    def pull(self, name):
+        print(f"[PROMPT STORE] PROMPT NOT VENDORED, PULLING FROM HUB : {name}")
+        from langchain import hub
+        pulled_prompt = hub.pull(name)
+
+        # chat prompts from the hub are single message templates, keep just the template text
+        if hasattr(pulled_prompt, "template"):
+            template = pulled_prompt.template
+        else:
+            template = "\n".join(m.prompt.template for m in pulled_prompt.messages)
+
+        prompt = PromptTemplate.from_template(template)
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.get_path(name), "w") as file:
+            json.dump({
+                "name": name,
+                "template": prompt.template,
+                "input_variables": prompt.input_variables
+            }, file, indent=4)
+        return prompt
+
+prompt_store = PromptStore()
@@ -0,0 +1,85 @@
+import asyncio
+import hashlib
+import threading
+from cachetools import LRUCache
+from langchain_core.documents import Document
+
+# optional second retrieval stage: the top candidates of the vector store are scored against the query
+# by a small cross-encoder running on the cpu and only the top_k best are kept.
+# sentence-transformers is only needed when the reranker is enabled (pip install sentence-transformers).
+# scores are cached per (query, chunk) so repeated and overlapping queries skip inference.
+class CrossEncoderReranker:
+    def __init__(self, enabled = False, model = "cross-encoder/ms-marco-MiniLM-L-6-v2", candidates = 50, top_k = 5, batch_size = 32, max_length = 512, cache_size = 10000):
+        self.enabled = enabled
+        self.model_name = model
+        self.candidates = candidates
+        self.top_k = top_k
+        self.batch_size = batch_size
+
+        self.lock = threading.Lock()
+        # one inference at a time, a single batch already keeps every core busy
+        self.inference_lock = threading.Lock()
+        self.cache = LRUCache(maxsize=cache_size)
+        self.stats = {
+            "reranks": 0,
+            "cache_hits": 0,
+            "cache_misses": 0
+        }
+
+        self.model = None
+        if enabled:
+            try:
+                from sentence_transformers import CrossEncoder
+            except ImportError:
+                raise Exception("[RERANKER:ERROR] sentence-transformers IS NOT INSTALLED, INSTALL IT OR DISABLE THE RERANKER")
+            print(f"[RERANKER] LOADING CROSS ENCODER : {model}")
+            self.model = CrossEncoder(model, max_length=max_length, device="cpu")
+
+    def get_key(self, query, document):
+        chunk = document.metadata.get("id") or document.page_content
+        return hashlib.sha256(f"{self.model_name}\0{query}\0{chunk}".encode("utf-8")).hexdigest()
+
+    # returns copies of the top_k documents, best first, with the cross-encoder score as rerank_score.
+    # the retrieval scores (score, vector_score) are left as they are
+    def rerank(self, query, documents):
+        if not self.enabled or len(documents) == 0:
+            return documents[:self.top_k]
+
+        keys = [self.get_key(query, d) for d in documents]
+        scores = {}
+        with self.lock:
+            for key in keys:
+                score = self.cache.get(key)
+                if score is not None:
+                    scores[key] = score
+            self.stats["reranks"] += 1
+            self.stats["cache_hits"] += len(scores)
+            self.stats["cache_misses"] += len(set(keys)) - len(scores)
+
+        missing = [(key, d) for key, d in dict(zip(keys, documents)).items() if key not in scores]
+        if len(missing) != 0:
+            with self.inference_lock:
+                predicted = self.model.predict([(query, d.page_content) for key, d in missing], batch_size=self.batch_size, show_progress_bar=False)
+            with self.lock:
+                for (key, d), score in zip(missing, predicted):
+                    scores[key] = float(score)
+                    self.cache[key] = float(score)
+
+        ranked = sorted(zip(keys, documents), key=lambda item: scores[item[0]], reverse=True)[:self.top_k]
+        reranked_documents = []
+        for key, d in ranked:
+            reranked_documents.append(Document(page_content=d.page_content, metadata={**d.metadata, "rerank_score": scores[key]}))
+        print(f"[RERANKER] KEPT {len(reranked_documents)} OF {len(documents)} CANDIDATES")
+        return reranked_documents
+
+    async def arerank(self, query, documents):
+        return await asyncio.to_thread(self.rerank, query, documents)
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self.cache)
+        stats["enabled"] = self.enabled
+        lookups = stats["cache_hits"] + stats["cache_misses"]
+        stats["hit_ratio"] = stats["cache_hits"] / lookups if lookups else 0.0
+        return stats
@@ -1,42 +1,181 @@
+import atexit
+import copy
+import threading
+import time
 from pathlib import Path
 from cachetools import LRUCache
 
+class EvictionAwareLRUCache(LRUCache):
+    def __init__(self, maxsize, on_evict):
+        super().__init__(maxsize=maxsize)
+        self.on_evict = on_evict
+
+    def popitem(self):
+        key, value = super().popitem()
+        self.on_evict(key, value)
+        return key, value
+
+# caches values in front of the interfaces in location_interface_map, keyed by the full path.
+# ttls maps a location prefix (e.g. "customer_config") to seconds after which a cached value is re-read.
+# with write_behind, set() only updates the cache and marks the key dirty. repeated writes to a key
+# are coalesced and dirty keys are written back every flush_interval seconds and at shutdown.
+# self.lock only guards the cache and the dirty bookkeeping, reads and writes of the interfaces run
+# outside of it under a per-key lock, so different keys are read and written concurrently and a
+# missing key is loaded by a single reader. key locks are striped: a fixed set of key_lock_stripes locks
+# is shared by hash, so their number does not grow with the number of keys ever accessed.
+# values are copied on get() and set(): callers own what they get and may mutate it, the cached value
+# only changes through set().
 class ResourceManager:
-    def __init__(self, cache_size=100, location_interface_map={}):
+    def __init__(self, cache_size=100, location_interface_map={}, write_behind=False, flush_interval=5, ttls=None, key_lock_stripes=64):
         self.location_interface_map = location_interface_map
-        self.cache = LRUCache(maxsize=cache_size)
+        self.cache = EvictionAwareLRUCache(maxsize=cache_size, on_evict=self._on_evict)
+        self.ttls = ttls or {}
+        self.lock = threading.RLock()
+        self.key_locks = [threading.Lock() for _ in range(key_lock_stripes)]
+        # flushes are serialized so a key is never written back by two flushes at once
+        self.flush_lock = threading.Lock()
+
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        # key -> value not yet written back. kept apart from the cache so evicted entries are still written back
+        self.dirty = {}
+        # key -> value being written back by the running flush, still served by get()
+        self.flushing = {}
+        self.stopping = threading.Event()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "expirations": 0,
+            "evictions": 0,
+            "writes": 0,
+            "coalesced_writes": 0,
+            "flushes": 0
+        }
+
+        if write_behind:
+            self._start_flush_thread()
+            atexit.register(self.close)
+
+    # never acquire a second key lock while holding one, two keys may share a stripe
+    def get_key_lock(self, key):
+        return self.key_locks[hash(key) % len(self.key_locks)]
 
     def get(self, path):
         path = Path(path)
-        effective_path = self.get_effective_path(path)
+        key = str(path)
 
-        # Check if the value is in cache
-        if effective_path in self.cache:
-            print("CACHE HIT")
-            return self.cache[effective_path]
+        found, value = self._get_cached(key)
+        if found:
+            return copy.deepcopy(value)
 
-        print("CACHE MISS")
-        interface = self.get_interface(path)
-        value = interface.read(effective_path)
+        with self.get_key_lock(key):
+            # another reader may have loaded it while this one waited
+            found, value = self._get_cached(key, count = False)
+            if found:
+                return copy.deepcopy(value)
 
-        self.cache[effective_path] = value
-        return value
+            print("CACHE MISS")
+            value = self.get_interface(path).read(self.get_effective_path(path))
+            with self.lock:
+                self.stats["misses"] += 1
+                # a write behind set() during the read is newer than what was read
+                for pending in (self.dirty, self.flushing):
+                    if key in pending:
+                        return copy.deepcopy(pending[key])
+                self.cache[key] = (value, self._get_expiry(path))
+        return copy.deepcopy(value)
+
+    # returns (found, value) from the dirty entries or the cache
+    def _get_cached(self, key, count = True):
+        with self.lock:
+            for pending in (self.dirty, self.flushing):
+                if key in pending:
+                    if count:
+                        print("CACHE HIT")
+                        self.stats["hits"] += 1
+                    return True, pending[key]
+
+            entry = self.cache.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or time.monotonic() < expires_at:
+                    if count:
+                        print("CACHE HIT")
+                        self.stats["hits"] += 1
+                    return True, value
+                self.stats["expirations"] += 1
+                self.cache.pop(key)
+        return False, None
 
     def set(self, path, value):
         path = Path(path)
-        effective_path = self.get_effective_path(path)
-        self.cache[effective_path] = value
-        interface = self.get_interface(path)
-        interface.write(effective_path, value)
+        key = str(path)
+        value = copy.deepcopy(value)
+
+        if self.write_behind:
+            with self.lock:
+                self.cache[key] = (value, self._get_expiry(path))
+                if key in self.dirty:
+                    self.stats["coalesced_writes"] += 1
+                self.dirty[key] = value
+            return
+
+        with self.get_key_lock(key):
+            self.get_interface(path).write(self.get_effective_path(path), value)
+            with self.lock:
+                self.cache[key] = (value, self._get_expiry(path))
+                self.stats["writes"] += 1
 
     def delete(self, path):
         path = Path(path)
-        effective_path = self.get_effective_path(path)
+        key = str(path)
+
+        with self.get_key_lock(key):
+            with self.lock:
+                self.cache.pop(key, None)
+                self.dirty.pop(key, None)
+                self.flushing.pop(key, None)
+            self.get_interface(path).delete(self.get_effective_path(path))
 
-        if effective_path in self.cache:
-            self.cache.pop(effective_path)
-        interface = self.get_interface(path)
-        interface.delete(effective_path)
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                if len(self.dirty) == 0:
+                    return
+                self.flushing = self.dirty
+                self.dirty = {}
+            print(f"[RESOURCE MANAGER] FLUSHING {len(self.flushing)} DIRTY ENTRIES")
+
+            for key, value in list(self.flushing.items()):
+                with self.get_key_lock(key):
+                    with self.lock:
+                        # deleted since the flush started
+                        if self.flushing.get(key) is not value:
+                            continue
+                    try:
+                        self._write_back(key, value)
+                    except Exception as e:
+                        print(f"[RESOURCE MANAGER:ERROR] WRITE BACK FAILED, RETRYING ON NEXT FLUSH : {e}")
+                        with self.lock:
+                            # unless it was set again in the meantime
+                            self.dirty.setdefault(key, value)
+
+            with self.lock:
+                self.flushing = {}
+                self.stats["flushes"] += 1
+
+    def close(self):
+        self.stopping.set()
+        self.flush()
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self.cache)
+            stats["dirty"] = len(self.dirty)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
 
     def get_interface(self, path):
         specified_location = path.parts[0]
@@ -45,3 +184,30 @@ class ResourceManager:
     def get_effective_path(self, path):
         base_path = Path(path.parts[0])
         return Path(path).relative_to(base_path)
+
+    def _get_expiry(self, path):
+        ttl = self.ttls.get(path.parts[0])
+        if ttl is None:
+            return None
+        return time.monotonic() + ttl
+
+    def _write_back(self, key, value):
+        path = Path(key)
+        self.get_interface(path).write(self.get_effective_path(path), value)
+        with self.lock:
+            self.stats["writes"] += 1
+
+    # called by the cache with the lock held. dirty entries stay in self.dirty until the next flush
+    def _on_evict(self, key, entry):
+        self.stats["evictions"] += 1
+
+    def _start_flush_thread(self):
+        def task():
+            while not self.stopping.wait(self.flush_interval):
+                try:
+                    self.flush()
+                except Exception as e:
+                    print(f"[RESOURCE MANAGER:ERROR] FLUSH FAILED : {e}")
+
+        flush_thread = threading.Thread(target=task, name="resource-manager-flush", daemon=True)
+        flush_thread.start()
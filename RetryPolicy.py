@@ -0,0 +1,46 @@
+import asyncio
+import random
+import time
+
+# rate limit and overload errors of the google and mistral apis, the ones worth waiting out
+def is_rate_limit_error(error):
+    message = str(error).lower()
+    return any(marker in message for marker in ("429", "resource exhausted", "resourceexhausted", "quota", "rate limit", "503", "unavailable"))
+
+# retries a callable with exponential backoff and jitter.
+# shared by everything that talks to rate limited remote apis (embeddings, llms, downloads)
+class RetryPolicy:
+    # retry_if optionally narrows retry_on further, e.g. to only rate limit errors
+    def __init__(self, max_retries = 5, base_delay = 1, max_delay = 30, retry_on = (Exception,), retry_if = None):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_on = retry_on
+        self.retry_if = retry_if
+
+    def get_delay(self, attempt):
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        return delay * random.uniform(0.5, 1)
+
+    def call(self, function, *args, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return function(*args, **kwargs)
+            except self.retry_on as e:
+                if attempt == self.max_retries or (self.retry_if and not self.retry_if(e)):
+                    raise
+                delay = self.get_delay(attempt)
+                print(f"[RETRY POLICY] ATTEMPT {attempt + 1} FAILED ({e}), RETRYING IN {delay:.2f}s")
+                time.sleep(delay)
+
+    # same as call() for coroutine functions, waiting without blocking the event loop
+    async def acall(self, function, *args, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await function(*args, **kwargs)
+            except self.retry_on as e:
+                if attempt == self.max_retries or (self.retry_if and not self.retry_if(e)):
+                    raise
+                delay = self.get_delay(attempt)
+                print(f"[RETRY POLICY] ATTEMPT {attempt + 1} FAILED ({e}), RETRYING IN {delay:.2f}s")
+                await asyncio.sleep(delay)
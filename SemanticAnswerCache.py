@@ -0,0 +1,155 @@
+import hashlib
+import itertools
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from cachetools import LRUCache
+
+# identifies the knowledge an answer was generated from. it changes whenever an artifact is ingested,
+# re-ingested with new content or deleted, so answers cached by another process are dropped as soon as
+# it sees the new config
+def get_knowledge_fingerprint(customer_config):
+    artifact_versions = [f'{ks.get("artifact_id")}:{ks.get("artifact_sha256") or ""}' for ks in customer_config.get("knowledge_summaries") or []]
+    return hashlib.sha256("\0".join(artifact_versions).encode("utf-8")).hexdigest()
+
+# per customer cache of final answers keyed by the embedding of the query. a query whose embedding
+# has a cosine similarity of at least similarity_threshold with a cached query gets the cached answer
+# without breaking, retrieving or answering it again.
+# entries are dropped when the customer's knowledge changes (invalidate(), or a new knowledge
+# fingerprint), after ttl seconds, and oldest first beyond max_entries_per_customer.
+class SemanticAnswerCache:
+    def __init__(self, enabled = True, similarity_threshold = 0.95, max_entries_per_customer = 1000, max_customers = 1000, ttl = 86400):
+        self.enabled = enabled
+        self.similarity_threshold = similarity_threshold
+        self.max_entries_per_customer = max_entries_per_customer
+        self.ttl = ttl
+
+        self.lock = threading.Lock()
+        self.customers = LRUCache(maxsize=max_customers)
+        # bumped on every invalidation, an answer computed before it must not be stored after it
+        self.generations = {}
+        self.entry_ids = itertools.count()
+        self.stats = {
+            "lookups": 0,
+            "hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "invalidations": 0,
+            "latency_saved_seconds": 0.0
+        }
+
+    def _normalize(self, vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm != 0 else vector
+
+    def get_generation(self, customer_id):
+        with self.lock:
+            return self.generations.get(str(customer_id), 0)
+
+    # lets callers skip embedding the query for a lookup that cannot hit. a customer without cached
+    # answers for this knowledge counts as a lookup and a miss
+    def has_answers(self, customer_id, knowledge_fingerprint):
+        if not self.enabled:
+            return False
+        with self.lock:
+            cache = self.customers.get(str(customer_id))
+            if cache is not None and cache["knowledge_fingerprint"] == knowledge_fingerprint and len(cache["entries"]) != 0:
+                return True
+            self.stats["lookups"] += 1
+            self.stats["misses"] += 1
+            return False
+
+    # returns the cached answer {"query", "paragraph", "response_code", "images", "latency", ...} or None
+    def lookup(self, customer_id, knowledge_fingerprint, query_vector):
+        if not self.enabled:
+            return None
+        query = self._normalize(query_vector)
+
+        with self.lock:
+            self.stats["lookups"] += 1
+            cache = self.customers.get(str(customer_id))
+            if cache is not None and cache["knowledge_fingerprint"] != knowledge_fingerprint:
+                self._invalidate(str(customer_id))
+                cache = None
+
+            entry = None
+            if cache is not None and len(cache["entries"]) != 0:
+                self._expire(cache)
+                if cache["matrix"] is None and len(cache["entries"]) != 0:
+                    cache["ids"] = list(cache["entries"])
+                    cache["matrix"] = np.stack([cache["entries"][id]["vector"] for id in cache["ids"]])
+                if cache["matrix"] is not None:
+                    scores = cache["matrix"] @ query
+                    best = int(np.argmax(scores))
+                    if scores[best] >= self.similarity_threshold:
+                        entry = cache["entries"][cache["ids"][best]]
+
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+
+            self.stats["hits"] += 1
+            self.stats["latency_saved_seconds"] += entry["latency"]
+            print(f"[SEMANTIC ANSWER CACHE] HIT FOR CUSTOMER {customer_id} WITH SIMILARITY {float(scores[best]):.3f} : {entry['query']}")
+            return {key: value for key, value in entry.items() if key != "vector"}
+
+    # latency is how long generating the answer took, reported as saved on every hit
+    def store(self, customer_id, knowledge_fingerprint, generation, query, query_vector, paragraph, response_code, images, latency):
+        if not self.enabled:
+            return
+        customer_id = str(customer_id)
+
+        with self.lock:
+            if self.generations.get(customer_id, 0) != generation:
+                return
+            cache = self.customers.get(customer_id)
+            if cache is None or cache["knowledge_fingerprint"] != knowledge_fingerprint:
+                cache = {"knowledge_fingerprint": knowledge_fingerprint, "entries": OrderedDict(), "ids": [], "matrix": None}
+                self.customers[customer_id] = cache
+
+            cache["entries"][next(self.entry_ids)] = {
+                "query": query,
+                "vector": self._normalize(query_vector),
+                "paragraph": paragraph,
+                "response_code": response_code,
+                "images": images,
+                "latency": latency,
+                "created_at": time.monotonic()
+            }
+            while len(cache["entries"]) > self.max_entries_per_customer:
+                cache["entries"].popitem(last=False)
+            cache["matrix"] = None
+            self.stats["stores"] += 1
+
+    def invalidate(self, customer_id):
+        with self.lock:
+            self._invalidate(str(customer_id))
+
+    def _invalidate(self, customer_id):
+        self.generations[customer_id] = self.generations.get(customer_id, 0) + 1
+        if self.customers.pop(customer_id, None) is not None:
+            self.stats["invalidations"] += 1
+            print(f"[SEMANTIC ANSWER CACHE] INVALIDATED CUSTOMER {customer_id}")
+
+    def _expire(self, cache):
+        if self.ttl is None:
+            return
+        expired_before = time.monotonic() - self.ttl
+        # entries are ordered oldest first
+        while len(cache["entries"]) != 0:
+            id, entry = next(iter(cache["entries"].items()))
+            if entry["created_at"] >= expired_before:
+                break
+            cache["entries"].popitem(last=False)
+            cache["matrix"] = None
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["customers"] = len(self.customers)
+            stats["entries"] = sum(len(cache["entries"]) for cache in self.customers.values())
+        stats["hit_ratio"] = stats["hits"] / stats["lookups"] if stats["lookups"] else 0.0
+        stats["average_latency_saved_seconds"] = stats["latency_saved_seconds"] / stats["hits"] if stats["hits"] else 0.0
+        return stats
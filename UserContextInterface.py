@@ -37,34 +37,103 @@
 
 import json
 import os
+import sqlite3
+import threading
 from pathlib import Path
 
+# user contexts are kept in a sqlite key-value table (one row per user) instead of one big json
+# file, so a write only touches the row of the user being written, not every user's context.
+# sqlite's journal keeps the store consistent if the process dies mid write.
 class UserContextInterface:
-    def __init__(self, filename='chat_history.json'):
+    def __init__(self, filename='user_contexts.db', legacy_filename=None):
         self._filename = filename
         Path(os.path.dirname(filename) or '.').mkdir(parents=True, exist_ok=True)
-        self._dictionary = self._load_dictionary()
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS user_contexts (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        # chat history is append only, one row per chat record, so a turn never rewrites the user context
+        self._connection.execute("CREATE TABLE IF NOT EXISTS chat_records (id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL, record TEXT NOT NULL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS chat_records_key ON chat_records (key, id)")
+        if legacy_filename:
+            self._import_legacy_file(legacy_filename)
 
-    def _load_dictionary(self):
-        if os.path.exists(self._filename):
-            with open(self._filename, 'r') as file:
-                return json.load(file)
-        return {}
+    # one time import of the old whole-file json store
+    def _import_legacy_file(self, legacy_filename):
+        with self._lock:
+            imported = self._connection.execute("SELECT value FROM meta WHERE key = ?", (legacy_filename,)).fetchone()
+            if imported or not os.path.exists(legacy_filename):
+                return
+            with open(legacy_filename, 'r') as file:
+                dictionary = json.load(file)
+            self._connection.execute("BEGIN IMMEDIATE")
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO user_contexts (key, value) VALUES (?, ?)",
+                [(key, self._serialize(value)) for key, value in dictionary.items()]
+            )
+            self._connection.execute("INSERT INTO meta (key, value) VALUES (?, 'imported')", (legacy_filename,))
+            self._connection.execute("COMMIT")
+            print(f"[USER CONTEXT INTERFACE] IMPORTED {len(dictionary)} USER CONTEXTS FROM {legacy_filename}")
 
-    def _save_dictionary(self):
-        with open(self._filename, 'w') as file:
-            json.dump(self._dictionary, file)
+    def _serialize(self, value):
+        return json.dumps(value, separators=(",", ":"))
 
     def read(self, key):
         key = str(key)
-        return self._dictionary.get(key)
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM user_contexts WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
 
     def write(self, key, value):
         key = str(key)
-        self._dictionary[key] = value
-        self._save_dictionary()
+        value = self._serialize(value)
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO user_contexts (key, value) VALUES (?, ?)", (key, value))
 
     def delete(self, key):
         key = str(key)
-        del self._dictionary[key]
-        self._save_dictionary()
\ No newline at end of file
+        with self._lock:
+            deleted = self._connection.execute("DELETE FROM user_contexts WHERE key = ?", (key,)).rowcount
+            self._connection.execute("DELETE FROM chat_records WHERE key = ?", (key,))
+        if deleted == 0:
+            raise KeyError(key)
+
+    # appends the records to the key's chat history and drops all but its window_limit latest records
+    def append_chat_records(self, key, records, window_limit = None):
+        key = str(key)
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            self._connection.executemany(
+                "INSERT INTO chat_records (key, record) VALUES (?, ?)",
+                [(key, self._serialize(record)) for record in records]
+            )
+            if window_limit is not None:
+                self._connection.execute(
+                    "DELETE FROM chat_records WHERE key = ? AND id <= (SELECT id FROM chat_records WHERE key = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                    (key, key, window_limit)
+                )
+            self._connection.execute("COMMIT")
+
+    def replace_chat_history(self, key, records, window_limit = None):
+        key = str(key)
+        if window_limit is not None:
+            records = records[-window_limit:] if window_limit else []
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            self._connection.execute("DELETE FROM chat_records WHERE key = ?", (key,))
+            self._connection.executemany(
+                "INSERT INTO chat_records (key, record) VALUES (?, ?)",
+                [(key, self._serialize(record)) for record in records]
+            )
+            self._connection.execute("COMMIT")
+
+    # oldest first
+    def read_chat_history(self, key):
+        key = str(key)
+        with self._lock:
+            rows = self._connection.execute("SELECT record FROM chat_records WHERE key = ? ORDER BY id", (key,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
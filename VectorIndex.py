@@ -0,0 +1,169 @@
+import threading
+import numpy as np
+
+# in-memory index over the embeddings of a single vector store (mongo collection).
+# vectors are stored l2-normalized in one contiguous float32 matrix so that cosine
+# similarity against every chunk is a single matrix-vector product.
+# mode "flat" scores every vector exactly, mode "ivf" clusters the vectors with
+# spherical k-means and only scores the vectors of the nprobe closest clusters.
+class VectorIndex:
+    def __init__(self, dimensions = 768, mode = "flat", nlist = None, nprobe = 8, train_threshold = 4096):
+        if mode not in ("flat", "ivf"):
+            raise Exception(f"[VECTOR INDEX:ERROR] UNSUPPORTED INDEX MODE : {mode}")
+
+        self.dimensions = dimensions
+        self.mode = mode
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.train_threshold = train_threshold
+
+        self.lock = threading.RLock()
+        self.size = 0
+        self.matrix = np.empty((1024, dimensions), dtype=np.float32)
+        self.ids = []
+        self.id_to_row = {}
+
+        # ivf state, only populated once the index has been trained
+        self.centroids = None
+        self.assignments = np.empty(1024, dtype=np.int32)
+        self.trained_size = 0
+
+    def __len__(self):
+        return self.size
+
+    def _normalize(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim == 1:
+            vectors = vectors.reshape(1, -1)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def _ensure_capacity(self, required):
+        capacity = self.matrix.shape[0]
+        if required <= capacity:
+            return
+        while capacity < required:
+            capacity = capacity * 2
+        matrix = np.empty((capacity, self.dimensions), dtype=np.float32)
+        matrix[:self.size] = self.matrix[:self.size]
+        self.matrix = matrix
+        assignments = np.empty(capacity, dtype=np.int32)
+        assignments[:self.size] = self.assignments[:self.size]
+        self.assignments = assignments
+
+    def add(self, ids, vectors):
+        if len(ids) == 0:
+            return
+        vectors = self._normalize(vectors)
+        if vectors.shape[1] != self.dimensions:
+            raise Exception(f"[VECTOR INDEX:ERROR] EXPECTED {self.dimensions} DIMENSIONS, GOT {vectors.shape[1]}")
+
+        with self.lock:
+            # re-adding an existing id replaces its vector
+            self.remove([id for id in ids if id in self.id_to_row])
+
+            start = self.size
+            end = start + len(ids)
+            self._ensure_capacity(end)
+            self.matrix[start:end] = vectors
+            for offset, id in enumerate(ids):
+                self.id_to_row[id] = start + offset
+            self.ids.extend(ids)
+            self.size = end
+
+            if self.centroids is not None:
+                self.assignments[start:end] = self._assign(vectors)
+
+            if self.mode == "ivf" and self._needs_training():
+                self._train()
+
+    def remove(self, ids):
+        with self.lock:
+            for id in ids:
+                row = self.id_to_row.pop(id, None)
+                if row is None:
+                    continue
+                # swap the last row into the freed slot to keep the matrix dense
+                last = self.size - 1
+                if row != last:
+                    last_id = self.ids[last]
+                    self.matrix[row] = self.matrix[last]
+                    self.assignments[row] = self.assignments[last]
+                    self.ids[row] = last_id
+                    self.id_to_row[last_id] = row
+                self.ids.pop()
+                self.size = last
+
+    def get_vector(self, id):
+        with self.lock:
+            row = self.id_to_row.get(id)
+            if row is None:
+                return None
+            return self.matrix[row].copy()
+
+    # candidate_ids restricts scoring to those vectors (e.g. the matches of a lexical prefilter)
+    def search(self, query_vector, k = 5, candidate_ids = None):
+        query = self._normalize(query_vector)[0]
+
+        with self.lock:
+            if self.size == 0:
+                return []
+
+            rows = None
+            if candidate_ids is not None:
+                rows = np.fromiter((self.id_to_row[id] for id in candidate_ids if id in self.id_to_row), dtype=np.int64)
+                if len(rows) == 0:
+                    return []
+            elif self.centroids is not None:
+                centroid_scores = self.centroids @ query
+                nprobe = min(self.nprobe, len(self.centroids))
+                probed = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+                rows = np.nonzero(np.isin(self.assignments[:self.size], probed))[0]
+                # not enough candidates in the probed clusters, fall back to exact search
+                if len(rows) < k:
+                    rows = None
+
+            if rows is None:
+                scores = self.matrix[:self.size] @ query
+            else:
+                scores = self.matrix[rows] @ query
+
+            k = min(k, len(scores))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top], kind="stable")]
+
+            if rows is not None:
+                return [(self.ids[rows[i]], float(scores[i])) for i in top]
+            return [(self.ids[i], float(scores[i])) for i in top]
+
+    def _needs_training(self):
+        if self.size < self.train_threshold:
+            return False
+        # retrain once the index has grown well past the size it was trained on
+        return self.centroids is None or self.size >= self.trained_size * 4
+
+    def _assign(self, vectors):
+        return np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+
+    def _train(self, iterations = 10, seed = 0):
+        nlist = self.nlist or max(1, int(np.sqrt(self.size)))
+        rng = np.random.default_rng(seed)
+        vectors = self.matrix[:self.size]
+
+        sample_size = min(self.size, nlist * 64)
+        sample = vectors[rng.choice(self.size, sample_size, replace=False)]
+        centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+
+        for _ in range(iterations):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            for c in range(nlist):
+                members = sample[labels == c]
+                if len(members) != 0:
+                    centroids[c] = members.sum(axis=0)
+            centroids = self._normalize(centroids)
+
+        self.centroids = centroids
+        self.assignments[:self.size] = self._assign(vectors)
+        self.trained_size = self.size
+        print(f"[VECTOR INDEX] TRAINED IVF INDEX WITH {nlist} LISTS OVER {self.size} VECTORS")
@@ -1,43 +1,320 @@
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
 from langchain_mongodb import MongoDBAtlasVectorSearch
-from pymongo import MongoClient
+from MongoConnectionManager import mongo_connection_manager
+from pymongo import ReturnDocument
+from pymongo.errors import CollectionInvalid
 from uuid import uuid4
 from langchain_core.documents import Document
-from sklearn.metrics.pairwise import cosine_similarity
-import heapq
+import asyncio
+import numpy as np
+import threading
+import time
+from VectorIndex import VectorIndex
+from LexicalIndex import LexicalIndex
+from BatchEmbedder import BatchEmbedder
+from EmbeddingCache import CachedEmbedder
+
+# one {"_id": vector store name, "version": n} document per vector store, bumped on every write
+VERSIONS_COLLECTION = "vector_store_versions"
 
 class VectorStoreInterface:
-    def __init__(self, embedder_model = "models/embedding-001" ,db_url = "mongodb://localhost:27017/", db_name = "toofan_local"):
+    def __init__(self, embedder_model = "models/embedding-001" ,db_url = "mongodb://localhost:27017/", db_name = "toofan_local", index_mode = "flat", retrieval_mode = "vector", lexical_weight = 0.5, rrf_k = 60, lexical_prefilter_size = None, embedder = None, embedding_batch_size = 100, embedding_max_concurrent_batches = 4, embedding_cache_size = 10000, embedding_disk_cache_directory = None, embedding_disk_cache_size_limit = 2**30, index_sync_interval = 5):
         if not db_url and not db_name:
             raise Exception(f"[VECTOR STORE INTERFACE:ERROR] db_url OR db_name FIELD NOT PROVIDED DURING INITIALIZATION")
         
-        self.embedder = GoogleGenerativeAIEmbeddings(model = embedder_model)
+        # any object exposing embed_query/embed_documents can be passed in place of the google embedder
+        if embedder is None:
+            embedder = GoogleGenerativeAIEmbeddings(model = embedder_model)
+        self.embedder = CachedEmbedder(
+            BatchEmbedder(embedder, batch_size = embedding_batch_size, max_concurrent_batches = embedding_max_concurrent_batches),
+            model_name = embedder_model,
+            cache_size = embedding_cache_size,
+            disk_cache_directory = embedding_disk_cache_directory,
+            disk_cache_size_limit = embedding_disk_cache_size_limit
+        )
         self.embedding_dimensions = 768
-        self.db_client = MongoClient(db_url)
-        self.db = self.db_client[db_name]
+        self.insert_batch_size = embedding_batch_size * embedding_max_concurrent_batches
+        self.db_url = db_url
+        self.db_name = db_name
+
+        # one in-memory vector index and one bm25 index per vector store, lazily built from mongo
+        # which stays the source of truth
+        self.index_mode = index_mode
+        self.indexes = {}
+        self.lexical_indexes = {}
+        self.indexes_lock = threading.Lock()
+        # writes made while an index is being built are buffered and replayed on top of what the
+        # scan found, so chunks inserted or deleted behind the cursor are not missed
+        self.index_updates_lock = threading.Lock()
+        self.pending_index_updates = {}
+        # every write to a vector store bumps its version in mongo. an index that is behind the version
+        # (another process wrote to the store) is rebuilt, checked at most every index_sync_interval seconds
+        self.index_sync_interval = index_sync_interval
+        self.index_versions = {}
+        self.index_checked_at = {}
+        self.stale_indexes = set()
+
+        # retrieval_mode "vector" ranks by cosine similarity only, "hybrid" fuses the vector and the
+        # bm25 rankings of text stores with reciprocal rank fusion, lexical_weight being the share of the
+        # bm25 ranking. image stores (short generated descriptions) are always ranked by cosine similarity.
+        # with lexical_prefilter_size, stores larger than that only score the vectors of their top
+        # lexical_prefilter_size lexical matches instead of the whole index. chunks sharing no term with
+        # the query are then not retrieved; queries with fewer lexical matches than the fusion depth
+        # search the whole index.
+        # the bm25 index is in memory like the vector index: built from mongo on first use in every
+        # process and kept in sync on ingestion, it is not persisted
+        if retrieval_mode not in ("vector", "hybrid"):
+            raise Exception(f"[VECTOR STORE INTERFACE:ERROR] UNSUPPORTED RETRIEVAL MODE : {retrieval_mode}")
+        self.retrieval_mode = retrieval_mode
+        self.lexical_weight = lexical_weight
+        self.rrf_k = rrf_k
+        self.lexical_prefilter_size = lexical_prefilter_size
+
+        # names of the collections known to exist, listed from mongo once and then kept up to date
+        # locally so that the hot path never has to list collections
+        self.known_collections = None
+        self.known_collections_lock = threading.Lock()
+
+    # resolved on every use so the shared client can be replaced after a fork
+    @property
+    def db(self):
+        return mongo_connection_manager.get_client(self.db_url)[self.db_name]
+
+    # motor database, only to be used from the event loop serving asgi requests
+    @property
+    def async_db(self):
+        return mongo_connection_manager.get_async_client(self.db_url)[self.db_name]
 
     # vector store will be equivalent to a collection.
     # the name of the vector_store/collection will be {customer_id}_{vector_store/image_vector_store}
     def get_vector_store(self, vector_store_name):
-        print(f"[VECTOR STORE INTERFACE] GETTING VECTOR STORE : {vector_store_name}")
         collection_name = vector_store_name
         collection = self.db[collection_name]
-        
-        if not collection_name in self.db.list_collection_names():
-            print(f"[VECTOR STORE INTERFACE] CREATING VECTOR STORE SINCE IT DOESN'T ALREADY EXIST : {vector_store_name}")
-            self.db.create_collection(collection_name)
+
+        known_collections = self.known_collections
+        if known_collections is not None and collection_name in known_collections:
+            return collection
+
+        with self.known_collections_lock:
+            # normally loaded at startup, see load_known_collections()
+            if self.known_collections is None:
+                self._load_known_collections()
+
+            if not collection_name in self.known_collections:
+                print(f"[VECTOR STORE INTERFACE] CREATING VECTOR STORE SINCE IT DOESN'T ALREADY EXIST : {vector_store_name}")
+                try:
+                    self.db.create_collection(collection_name)
+                except CollectionInvalid:
+                    # created in the meantime by another process
+                    pass
+                self.ensure_indexes(collection)
+                self.known_collections.add(collection_name)
         
         return collection
 
+    # to be called once at startup, so the first request does not list collections or create indexes
+    def load_known_collections(self):
+        with self.known_collections_lock:
+            self._load_known_collections()
+
+    def _load_known_collections(self):
+        collection_names = set(self.db.list_collection_names())
+        # vector stores created before the supporting indexes existed get them now, create_index is idempotent
+        for collection_name in collection_names:
+            if collection_name.endswith("_vector_store"):
+                self.ensure_indexes(self.db[collection_name])
+        self.known_collections = collection_names
+        print(f"[VECTOR STORE INTERFACE] {len(collection_names)} KNOWN COLLECTIONS LOADED")
+
+    def ensure_indexes(self, collection):
+        collection.create_index("id")
+        collection.create_index("metadata.artifact_id")
+
+    def get_store_version(self, vector_store_name):
+        version = self.db[VERSIONS_COLLECTION].find_one({"_id": vector_store_name})
+        return version["version"] if version is not None else 0
+
+    def _bump_store_version(self, vector_store_name):
+        version = self.db[VERSIONS_COLLECTION].find_one_and_update(
+            {"_id": vector_store_name}, {"$inc": {"version": 1}}, upsert=True, return_document=ReturnDocument.AFTER
+        )
+        return version["version"]
+
+    # true when the loaded index can be used without checking the store version again
+    def is_index_current(self, vector_store_name):
+        return (
+            vector_store_name in self.indexes
+            and vector_store_name not in self.stale_indexes
+            and time.monotonic() - self.index_checked_at.get(vector_store_name, 0) < self.index_sync_interval
+        )
+
+    def _check_index_version(self, vector_store_name):
+        with self.index_updates_lock:
+            self.index_checked_at[vector_store_name] = time.monotonic()
+            if self.get_store_version(vector_store_name) != self.index_versions.get(vector_store_name):
+                print(f"[VECTOR STORE INTERFACE] INDEX IS BEHIND THE STORE, REBUILDING : {vector_store_name}")
+                self.stale_indexes.add(vector_store_name)
+
+    def get_index(self, vector_store_name, collection, load_batch_size = 10000):
+        index = self.indexes.get(vector_store_name)
+        if index is not None:
+            if not self.is_index_current(vector_store_name):
+                self._check_index_version(vector_store_name)
+            if vector_store_name not in self.stale_indexes:
+                return index
+            # a stale index keeps serving while another thread rebuilds it
+            if not self.indexes_lock.acquire(blocking=False):
+                return index
+        else:
+            self.indexes_lock.acquire()
+
+        try:
+            index = self.indexes.get(vector_store_name)
+            if index is not None and vector_store_name not in self.stale_indexes:
+                return index
+            return self._build_index(vector_store_name, collection, load_batch_size)
+        finally:
+            self.indexes_lock.release()
+
+    def _build_index(self, vector_store_name, collection, load_batch_size):
+        print(f"[VECTOR STORE INTERFACE] BUILDING INDEX : {vector_store_name}")
+        with self.index_updates_lock:
+            self.pending_index_updates[vector_store_name] = []
+            version = self.get_store_version(vector_store_name)
+
+        index = VectorIndex(dimensions = self.embedding_dimensions, mode = self.index_mode)
+        lexical_index = LexicalIndex()
+        try:
+            ids = []
+            vectors = []
+            texts = []
+            for d in collection.find({"id": {"$exists": True}}, {"_id": 0, "id": 1, "embedding": 1, "page_content": 1}):
+                ids.append(d["id"])
+                vectors.append(d["embedding"])
+                texts.append(d.get("page_content") or "")
+                if len(ids) == load_batch_size:
+                    index.add(ids, vectors)
+                    lexical_index.add(ids, texts)
+                    ids = []
+                    vectors = []
+                    texts = []
+            index.add(ids, vectors)
+            lexical_index.add(ids, texts)
+        except Exception:
+            with self.index_updates_lock:
+                self.pending_index_updates.pop(vector_store_name, None)
+            raise
+
+        with self.index_updates_lock:
+            # adding an id the scan already found replaces it
+            pending_updates = self.pending_index_updates.pop(vector_store_name)
+            for ids, vectors, texts in pending_updates:
+                self._apply_index_update(index, lexical_index, ids, vectors, texts)
+
+            # writes of other processes during the scan may have been missed, those are caught by the next check
+            current_version = self.get_store_version(vector_store_name)
+            self.index_versions[vector_store_name] = current_version if current_version == version + len(pending_updates) else version
+            self.index_checked_at[vector_store_name] = time.monotonic()
+
+            # the lexical index is published first, a loaded vector index implies a loaded lexical one
+            self.lexical_indexes[vector_store_name] = lexical_index
+            self.indexes[vector_store_name] = index
+            self.stale_indexes.discard(vector_store_name)
+        print(f"[VECTOR STORE INTERFACE] INDEX BUILT WITH {len(index)} VECTORS : {vector_store_name}")
+        return index
+
+    # records a write to the store in the loaded index, or in the buffer of the index being built.
+    # vectors None removes the ids
+    def _update_index(self, vector_store_name, ids, vectors = None, texts = None):
+        with self.index_updates_lock:
+            version = self._bump_store_version(vector_store_name)
+
+            pending_updates = self.pending_index_updates.get(vector_store_name)
+            if pending_updates is not None:
+                pending_updates.append((ids, vectors, texts))
+
+            index = self.indexes.get(vector_store_name)
+            if index is not None:
+                self._apply_index_update(index, self.lexical_indexes[vector_store_name], ids, vectors, texts)
+                # still in step with the store unless another process wrote to it in the meantime
+                if pending_updates is None and self.index_versions.get(vector_store_name) == version - 1:
+                    self.index_versions[vector_store_name] = version
+
+    def _apply_index_update(self, index, lexical_index, ids, vectors, texts):
+        if vectors is None:
+            index.remove(ids)
+            lexical_index.remove(ids)
+        else:
+            index.add(ids, vectors)
+            lexical_index.add(ids, texts)
+
+    # returns [(id, score, vector_score)] of the k best chunks, best first. the indexes must already be
+    # loaded (get_index). score is what the chunks are ranked by: the fused reciprocal rank score in
+    # hybrid mode, otherwise the cosine similarity. vector_score always is the cosine similarity
+    def search(self, vector_store_name, query, query_vector, k = 5):
+        index = self.indexes[vector_store_name]
+        if self.retrieval_mode == "vector" or vector_store_name.endswith("_image_vector_store"):
+            return [(id, score, score) for id, score in index.search(query_vector, k)]
+
+        lexical_index = self.lexical_indexes[vector_store_name]
+        # both rankings are cut deeper than k so that fusion has something to work with
+        fetch_k = max(k * 4, 20)
+
+        if self.lexical_prefilter_size and len(index) > self.lexical_prefilter_size:
+            lexical_results = lexical_index.search(query, self.lexical_prefilter_size)
+            if len(lexical_results) >= fetch_k:
+                vector_results = index.search(query_vector, fetch_k, candidate_ids=[id for id, score in lexical_results])
+            else:
+                vector_results = index.search(query_vector, fetch_k)
+            lexical_results = lexical_results[:fetch_k]
+        else:
+            vector_results = index.search(query_vector, fetch_k)
+            lexical_results = lexical_index.search(query, fetch_k)
+
+        vector_scores = dict(vector_results)
+        fused_scores = {}
+        for weight, results in ((1 - self.lexical_weight, vector_results), (self.lexical_weight, lexical_results)):
+            for rank, (id, score) in enumerate(results):
+                fused_scores[id] = fused_scores.get(id, 0.0) + weight / (self.rrf_k + rank + 1)
+
+        results = sorted(fused_scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        query = np.asarray(query_vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        fused_results = []
+        for id, score in results:
+            vector_score = vector_scores.get(id)
+            # matched lexically only
+            if vector_score is None:
+                vector = index.get_vector(id)
+                vector_score = float(vector @ query) if vector is not None else None
+            fused_results.append((id, score, vector_score))
+        return fused_results
+
+    # documents can be any iterable (e.g. a generator of chunks). they are consumed, embedded and
+    # inserted insert_batch_size at a time so memory stays bounded regardless of the artifact size
     def embed(self, vector_store_name, documents):
-        print(f"[VECTOR STORE INTERFACE] EMBEDDING {len(documents)} DOCUMENTS : {vector_store_name}")
+        print(f"[VECTOR STORE INTERFACE] EMBEDDING DOCUMENTS : {vector_store_name}")
         collection_name = vector_store_name
         collection = self.get_vector_store(collection_name)
 
-        to_be_inserted = []
+        batch = []
+        total = 0
         for d in documents:
-            print(f"[VECTOR STORE INTERFACE] EMBEDDING CHUNK TO VECTOR STORE : {vector_store_name}")
-            vector = self.embedder.embed_query(d.page_content)
+            batch.append(d)
+            if len(batch) == self.insert_batch_size:
+                total += self._embed_batch(vector_store_name, collection, batch)
+                batch = []
+        if len(batch) != 0:
+            total += self._embed_batch(vector_store_name, collection, batch)
+
+        print(f"[VECTOR STORE INTERFACE] EMBEDDED {total} DOCUMENTS : {vector_store_name}")
+        return collection
+
+    def _embed_batch(self, vector_store_name, collection, documents):
+        vectors = self.embedder.embed_documents([d.page_content for d in documents])
+
+        to_be_inserted = []
+        for d, vector in zip(documents, vectors):
             d = d.dict()
             
             d["embedding"] = vector
@@ -48,37 +325,87 @@ class VectorStoreInterface:
             to_be_inserted.append(d)
 
         collection.insert_many(to_be_inserted)
-        return collection
+
+        self._update_index(
+            vector_store_name,
+            [d["id"] for d in to_be_inserted],
+            [d["embedding"] for d in to_be_inserted],
+            [d["page_content"] for d in to_be_inserted]
+        )
+
+        return len(to_be_inserted)
     
-    def retrieve(self, vector_store_name, query, k=5):
+    def embed_query(self, query):
+        return self.embedder.embed_query(query)
+
+    async def aembed_query(self, query):
+        return await self.embedder.aembed_query(query)
+
+    # query_vector can be passed in when the same query is run against several vector stores
+    def retrieve(self, vector_store_name, query, k=5, query_vector=None):
         print(f"[VECTOR STORE INTERFACE] RETRIEVING TOP {k} MOST SIMILAR DOCUMENTS : {vector_store_name}")
-        query_vector = self.embedder.embed_query(query)
+        if query_vector is None:
+            query_vector = self.embedder.embed_query(query)
 
         collection_name = vector_store_name
         collection = self.get_vector_store(collection_name)
-        counter = 0
-        min_heap = []
-        # iterating over all documents in the vector store
-        for d in collection.find({}):
-            similarity = cosine_similarity([query_vector], [d["embedding"]])[0][0]
-            print(d["page_content"])
-            print(f"COSINE SIMILARITY : {similarity}\n")
-
-            if len(min_heap) < k:
-                print("won")
-                heapq.heappush(min_heap, (similarity, counter, d))
-            else:
-                print("gun")
-                heapq.heappushpop(min_heap, (similarity, counter, d))
-            counter = counter+1
+        # makes sure the indexes are loaded
+        self.get_index(collection_name, collection)
+
+        results = self.search(collection_name, query, query_vector, k)
+        if len(results) == 0:
+            return []
+
+        found_documents = {
+            d["id"]: d for d in collection.find({"id": {"$in": [id for id, score, vector_score in results]}}, {"_id": 0, "embedding": 0})
+        }
+
+        return self._to_documents(results, found_documents)
+
+    # same as retrieve() without blocking the event loop. the chunks are fetched through motor, the
+    # index search and building indexes that are not loaded yet run in threads
+    async def aretrieve(self, vector_store_name, query, k=5, query_vector=None):
+        print(f"[VECTOR STORE INTERFACE] RETRIEVING TOP {k} MOST SIMILAR DOCUMENTS : {vector_store_name}")
+        if query_vector is None:
+            query_vector = await self.embedder.aembed_query(query)
+
+        if not self.is_index_current(vector_store_name):
+            await asyncio.to_thread(lambda: self.get_index(vector_store_name, self.get_vector_store(vector_store_name)))
+
+        results = await asyncio.to_thread(self.search, vector_store_name, query, query_vector, k)
+        if len(results) == 0:
+            return []
+
+        cursor = self.async_db[vector_store_name].find({"id": {"$in": [id for id, score, vector_score in results]}}, {"_id": 0, "embedding": 0})
+        found_documents = {
+            d["id"]: d async for d in cursor
+        }
 
-        most_similar_documents = [doc for _,_, doc in sorted(min_heap, reverse=True)]
+        return self._to_documents(results, found_documents)
 
-        print("AFTER ITERATION")
+    # embeddings of already indexed chunks as {id: vector}, chunks of unloaded indexes are left out
+    def get_vectors(self, vector_store_name, ids):
+        index = self.indexes.get(vector_store_name)
+        if index is None:
+            return {}
+        vectors = {}
+        for id in ids:
+            vector = index.get_vector(id)
+            if vector is not None:
+                vectors[id] = vector
+        return vectors
 
+    # results are (id, score, vector_score) in rank order, found_documents maps id -> mongo document
+    def _to_documents(self, results, found_documents):
         langchain_documents = []
-        for d in most_similar_documents:
+        for id, score, vector_score in results:
+            d = found_documents.get(id)
+            # the index can briefly be ahead of another process deleting from mongo
+            if d is None:
+                continue
             document_data = {key:d[key] for key in d}
+            document_data["metadata"]["score"] = score
+            document_data["metadata"]["vector_score"] = vector_score
             langchain_documents.append(Document(
                 **document_data
             ))
@@ -96,23 +423,25 @@ class VectorStoreInterface:
                 "$in":ids
             }
         })
+        self._update_index(vector_store_name, ids)
 
         return collection
 
-    def delete_by_field(self, vector_store_name, key, values):
+    # validate_field rejects keys that no chunk of the store has, turn it off when the store may be empty
+    def delete_by_field(self, vector_store_name, key, values, validate_field = True):
         collection_name = vector_store_name
         collection = self.get_vector_store(collection_name)
 
-        field_exists = collection.find_one({key: {"$exists": True}}) is not None
-
-        if not field_exists:
+        if validate_field and collection.find_one({key: {"$exists": True}}) is None:
             raise Exception(f"[VECTOR STORE INTERFACE:ERROR] INVALID FIELD PROVIDED : {key}")
-        
+
+        ids = collection.distinct("id", {key: {"$in": values}})
         collection.delete_many({
             key: {
                 "$in": values
             }
         })
+        self._update_index(vector_store_name, ids)
 
         return collection
 
@@ -1,11 +1,13 @@
-from mistralai import Mistral
-
-from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 
-from langchain import hub
+from AgentRegistry import agent_registry
+from PromptStore import prompt_store
+from RetryPolicy import RetryPolicy, is_rate_limit_error
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 
+import asyncio
 import os
 import re
 
@@ -13,9 +15,64 @@ import re
 # from dotenv import load_dotenv
 # load_dotenv()
 
+# rough token estimate (~4 characters per token), good enough for budgeting prompt sizes
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+# schema the batch classifiers' structured output is constrained to: {"results": [{"index": i, key: bool}, ...]}
+def get_batch_schema(key, description):
+    return {
+        "title": "batch_decisions",
+        "description": "One decision per numbered item",
+        "type": "object",
+        "properties": {
+            "results": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "index": {"type": "integer", "description": "Index of the item"},
+                        key: {"type": "boolean", "description": description}
+                    },
+                    "required": ["index", key]
+                }
+            }
+        },
+        "required": ["results"]
+    }
+
+# reads the structured batch response as a list of count decisions. an item the model left out,
+# repeated or answered with anything but a boolean is None, so the caller can decide it on its own
+def parse_batch_decisions(response, count, key):
+    decisions = [None] * count
+    results = response.get("results") if isinstance(response, dict) else None
+    if not isinstance(results, list):
+        print(f"[AGENTS:ERROR] UNEXPECTED BATCH RESPONSE : {response}")
+        return decisions
+    seen = set()
+    repeated = set()
+    for result in results:
+        if not isinstance(result, dict):
+            continue
+        index = result.get("index")
+        value = result.get(key)
+        if isinstance(index, int) and 0 <= index < count and isinstance(value, bool):
+            if index in seen:
+                repeated.add(index)
+            seen.add(index)
+            decisions[index] = value
+    for index in repeated:
+        decisions[index] = None
+    if len(results) != count:
+        print(f"[AGENTS:ERROR] BATCH RESPONSE HAS {len(results)} ENTRIES FOR {count} ITEMS")
+    return decisions
+
+def format_numbered(items):
+    return "\n".join(f"{i}: {item}" for i, item in enumerate(items))
+
 class ImageToDescriptionAgent:
     def __init__(self, model = "pixtral-12b-2409"):
-        self.mistral_client = Mistral(api_key = os.environ["MISTRAL_API_KEY"])
+        self.mistral_client = agent_registry.get_mistral_client()
         self.model = model
 
     def describe(self, base_64_image):
@@ -47,65 +104,121 @@ class ImageToDescriptionAgent:
 
 class QueryPreprocessingAgent:
     def __init__(self, model = "gemini-1.5-flash"):
-        self.gemini_client = ChatGoogleGenerativeAI(model=model)
+        self.gemini_client = agent_registry.get_gemini_client(model)
         self.model = model
 
-    def break_query(self, query):
-        prompt = PromptTemplate.from_template("""
+        # chains are compiled once per agent, agents themselves are shared through the agent registry
+        self.break_query_chain = PromptTemplate.from_template("""
             Break the following query into component sub-queries.
             Output each sub-query on a new line.
             Strictly avoid redundant sub-queries and keep the form of the sub query same as the original query wherever possible
             Strictly follow the following format and output text in the following format "<sub_query1> \n <sub_query2> \n <sub_query3> ..."                            
             
             Query: {query}
-        """)
-        chain = prompt | self.gemini_client | StrOutputParser()
-        response = chain.invoke(query)
-        # return [q.strip() for q in re.split(r'\\?n', response) if q.strip()]
-        return [q.strip() for q in response.split("\n") if q.strip()]
-    
-    def augment_query(self, query):
-        prompt = PromptTemplate.from_template("""
+        """) | self.gemini_client | StrOutputParser()
+
+        self.augment_query_chain = PromptTemplate.from_template("""
             Augment the following query into 3 variations while preserving the meaning of the query.
             Output each variant on a new line:
             Query: {query}
             Queries:                                 
-        """)
-        chain = prompt | self.gemini_client | StrOutputParser()
-        response = chain.invoke(query)
+        """) | self.gemini_client | StrOutputParser()
+
+    def break_query(self, query):
+        response = self.break_query_chain.invoke(query)
+        # return [q.strip() for q in re.split(r'\\?n', response) if q.strip()]
+        return [q.strip() for q in response.split("\n") if q.strip()]
+
+    async def abreak_query(self, query):
+        response = await self.break_query_chain.ainvoke(query)
+        return [q.strip() for q in response.split("\n") if q.strip()]
+    
+    def augment_query(self, query):
+        response = self.augment_query_chain.invoke(query)
         return [q.strip() for q in response.split("\n") if q.strip()]
     
 class SummarizingAgent:
-    def __init__(self, model = "gemini-1.5-flash"):
-        self.llm = ChatGoogleGenerativeAI(model=model)
+    def __init__(self, model = "gemini-1.5-flash", max_workers = 8, map_batch_token_budget = 4000, reduce_token_budget = 24000, max_reduce_depth = 6):
+        self.llm = agent_registry.get_gemini_client(model)
+        # vendored hub prompts, read from the local prompt store so ingestion works offline
+        self.map_chain = prompt_store.get("rlm/map-prompt") | self.llm | StrOutputParser()
+        self.reduce_chain = prompt_store.get("rlm/reduce-prompt") | self.llm | StrOutputParser()
+
+        # small pages are packed together until a map call reaches map_batch_token_budget.
+        # once the joined map summaries exceed reduce_token_budget they are reduced as a tree.
+        self.map_batch_token_budget = map_batch_token_budget
+        self.reduce_token_budget = reduce_token_budget
+        self.max_reduce_depth = max_reduce_depth
+
+        # the pool is shared by every upload going through this agent, bounding concurrent llm calls
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="summarizer")
+        self.retry_policy = RetryPolicy(max_retries=6, base_delay=2, max_delay=60, retry_if=is_rate_limit_error)
 
     def summarize_from_documents(self, documents):
         print("SUMMARIZING")
-        map_prompt = hub.pull("rlm/map-prompt")
-        print(map_prompt)
-        reduce_prompt = hub.pull("rlm/reduce-prompt")
-        print(reduce_prompt)
-
-        summaries = []
-        for d in documents:
-            response = self.llm.invoke(map_prompt.format(docs=d.page_content))
-            summaries.append(response.content)
-            print(response)
+        batches = self._pack((d.page_content for d in documents), self.map_batch_token_budget)
+        summaries = list(self._map_concurrently(self._map, batches))
+        print(f"[SUMMARIZING AGENT] {len(summaries)} MAP SUMMARIES GENERATED")
 
-        final_summary = self.llm.invoke(
-        reduce_prompt.format(doc_summaries="\n\n".join(summaries))).content
+        final_summary = self.reduce_summaries(summaries)
 
         print(final_summary)
 
         return final_summary
+
+    def reduce_summaries(self, summaries):
+        for depth in range(self.max_reduce_depth):
+            if len(summaries) <= 1 or estimate_tokens("\n\n".join(summaries)) <= self.reduce_token_budget:
+                break
+
+            groups = list(self._pack(summaries, self.reduce_token_budget))
+            # every summary is too large to share a group, pair them up so each level still shrinks
+            if len(groups) == len(summaries):
+                groups = ["\n\n".join(summaries[i:i + 2]) for i in range(0, len(summaries), 2)]
+            print(f"[SUMMARIZING AGENT] TREE REDUCE LEVEL {depth + 1} : {len(summaries)} SUMMARIES INTO {len(groups)}")
+            summaries = list(self._map_concurrently(self._reduce, groups))
+
+        return self._reduce("\n\n".join(summaries))
+
+    def _map(self, text):
+        return self.retry_policy.call(self.map_chain.invoke, {"docs":text})
+
+    def _reduce(self, text):
+        return self.retry_policy.call(self.reduce_chain.invoke, {"doc_summaries":text})
+
+    # lazily packs consecutive texts into joined batches of at most token_budget tokens
+    def _pack(self, texts, token_budget):
+        batch = []
+        batch_tokens = 0
+        for text in texts:
+            tokens = estimate_tokens(text)
+            if len(batch) != 0 and batch_tokens + tokens > token_budget:
+                yield "\n\n".join(batch)
+                batch = []
+                batch_tokens = 0
+            batch.append(text)
+            batch_tokens += tokens
+        if len(batch) != 0:
+            yield "\n\n".join(batch)
+
+    # runs function over items on the shared pool, keeping at most 2 * max_workers items in flight
+    # so a lazy iterable is never fully materialized. results are yielded in input order.
+    def _map_concurrently(self, function, items):
+        in_flight = deque()
+        for item in items:
+            in_flight.append(self.executor.submit(function, item))
+            if len(in_flight) >= self.max_workers * 2:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
     
 class QueryAnsweringAgent:
     def __init__(self, model = "gemini-1.5-flash"):
-        self.gemini_client = ChatGoogleGenerativeAI(model=model)
+        self.gemini_client = agent_registry.get_gemini_client(model)
         self.model = model
 
-    def answer(self, query, context):
-        prompt = PromptTemplate.from_template("""
+        self.chain = PromptTemplate.from_template("""
             Answer the query based on the provided context.
             Do not use terms like "based on the following text" or "in the text" or "provided text"
             Respond confidently and directly with authoritative knowledge, using concise, professional language and taking ownership of the response.
@@ -115,22 +228,39 @@ class QueryAnsweringAgent:
                             
             <Query>{query}</Query>
             <Context>{context}</Context>
-        """)
+        """) | self.gemini_client | StrOutputParser()
 
-        chain = prompt | self.gemini_client | StrOutputParser()
+    def answer(self, query, context):
+        response = self.chain.invoke({"query":query,
+                                 "context":context
+                                })
+        return response
 
-        response = chain.invoke({"query":query,
+    async def aanswer(self, query, context):
+        response = await self.chain.ainvoke({"query":query,
                                  "context":context
                                 })
         return response
 
+    # yields the answer as it is generated
+    def stream(self, query, context):
+        for token in self.chain.stream({"query":query,
+                                 "context":context
+                                }):
+            yield token
+
+    async def astream(self, query, context):
+        async for token in self.chain.astream({"query":query,
+                                 "context":context
+                                }):
+            yield token
+
 class ImageDescriptionRelavancyCheckAgent:
     def __init__(self, model = "gemini-1.5-flash"):
-        self.gemini_client = ChatGoogleGenerativeAI(model=model)
+        self.gemini_client = agent_registry.get_gemini_client(model)
         self.model = model
 
-    def answer_query(self, query, context, image_description):
-        prompt = PromptTemplate.from_template("""
+        self.chain = PromptTemplate.from_template("""
             You are an expert at determining whether an image is relavant to the context and user query based on its description
             simply answer in 'yes' or 'no' only                                  
     
@@ -138,23 +268,72 @@ class ImageDescriptionRelavancyCheckAgent:
             <Context>{context}</Context>
             <ImageDescription>{image_description}</ImageDescription>                                  
                                               
-        """)
+        """) | self.gemini_client | StrOutputParser()
+
+        self.batch_chain = PromptTemplate.from_template("""
+            You are an expert at determining whether an image is relavant to a user query based on its description.
+            For each of the following {count} pairs, decide whether the described image is relavant to the query of the same pair.
 
-        chain = prompt | self.gemini_client | StrOutputParser()
+            {pairs}
+
+            Return exactly one result per pair.
+        """) | self.gemini_client.with_structured_output(get_batch_schema("relevant", "Whether the described image is relavant to the query of the pair"))
+
+    def answer_query(self, query, context, image_description):
+        response = self.chain.invoke({"query":query,
+                                 "context":context,
+                                 "image_description":image_description
+                                })
+        return response
 
-        response = chain.invoke({"query":query,
+    async def aanswer_query(self, query, context, image_description):
+        response = await self.chain.ainvoke({"query":query,
                                  "context":context,
                                  "image_description":image_description
                                 })
         return response
 
+    # judges every (query, image description) pair with a single call, returns one boolean per pair.
+    # pairs the response says nothing usable about are judged one by one with answer_query
+    def judge_batch(self, pairs):
+        if len(pairs) == 0:
+            return []
+        try:
+            decisions = parse_batch_decisions(self.batch_chain.invoke(self._get_batch_input(pairs)), len(pairs), "relevant")
+        except Exception as e:
+            print(f"[IMAGE RELEVANCY CHECK AGENT:ERROR] BATCH JUDGEMENT FAILED, JUDGING ONE BY ONE : {e}")
+            decisions = [None] * len(pairs)
+        for i, (query, image_description) in enumerate(pairs):
+            if decisions[i] is None:
+                decisions[i] = "yes" in self.answer_query(query, image_description, image_description).lower()
+        return decisions
+
+    async def ajudge_batch(self, pairs):
+        if len(pairs) == 0:
+            return []
+        try:
+            decisions = parse_batch_decisions(await self.batch_chain.ainvoke(self._get_batch_input(pairs)), len(pairs), "relevant")
+        except Exception as e:
+            print(f"[IMAGE RELEVANCY CHECK AGENT:ERROR] BATCH JUDGEMENT FAILED, JUDGING ONE BY ONE : {e}")
+            decisions = [None] * len(pairs)
+        undecided = [i for i, decision in enumerate(decisions) if decision is None]
+        responses = await asyncio.gather(*[self.aanswer_query(pairs[i][0], pairs[i][1], pairs[i][1]) for i in undecided])
+        for i, response in zip(undecided, responses):
+            decisions[i] = "yes" in response.lower()
+        return decisions
+
+    def _get_batch_input(self, pairs):
+        return {
+            "count":len(pairs),
+            "pairs":"\n".join(f"<Pair index=\"{i}\"><Query>{query}</Query><ImageDescription>{image_description}</ImageDescription></Pair>" for i, (query, image_description) in enumerate(pairs))
+        }
+
 class WatchmanAgent:
     def __init__(self, model = "gemini-1.5-flash"):
-        self.gemini_client = ChatGoogleGenerativeAI(model=model)
+        self.gemini_client = agent_registry.get_gemini_client(model)
         self.model = model
 
-    def guard(self, query, knowledge_summary):
-        prompt = PromptTemplate.from_template("""
+        self.chain = PromptTemplate.from_template("""
         You are an expert at determining whether a user query is specific or general in nature, based on the provided knowledge summary.
 
         A query is specific if it can be potentially answered using the knowledge represented in the provided knowledge summary. If the query is specific, respond with a direct "no."
@@ -164,31 +343,93 @@ class WatchmanAgent:
         
         <Query> {query} </Query>
         <KnowledgeSummary> {knowledge_summary} </KnowledgeSummary>
-        """)
+        """) | self.gemini_client | StrOutputParser()
+
+        # classifies every sub-query against the knowledge summary in one call
+        self.batch_chain = PromptTemplate.from_template("""
+        You are an expert at determining whether user queries are specific or general in nature, based on the provided knowledge summary.
+
+        A query is specific if it can be potentially answered using the knowledge represented in the provided knowledge summary.
+        Even if the query is somewhat related to the knowledge summary, the query is specific.
+        Keep in mind that even tho the summary might not contain the answer, the knowledge it is representing might.
+        A query is general if it is broad, abstract, or not explicitly tied to the provided knowledge summary.
+
+        <Queries>
+        {queries}
+        </Queries>
+        <KnowledgeSummary> {knowledge_summary} </KnowledgeSummary>
+
+        Return exactly one result for each of the {count} queries.
+        """) | self.gemini_client.with_structured_output(get_batch_schema("general", "Whether the query is general"))
+
+    def guard(self, query, knowledge_summary):
+        response = self.chain.invoke({
+            "query":query,
+            "knowledge_summary":knowledge_summary
+            })
 
-        chain = prompt | self.gemini_client | StrOutputParser()
+        return response
 
-        response = chain.invoke({
+    async def aguard(self, query, knowledge_summary):
+        response = await self.chain.ainvoke({
             "query":query,
             "knowledge_summary":knowledge_summary
             })
 
         return response
+
+    # returns one boolean per query, True meaning general. queries the response says nothing usable
+    # about are classified one by one with guard
+    def guard_batch(self, queries, knowledge_summary):
+        if len(queries) == 0:
+            return []
+        try:
+            decisions = parse_batch_decisions(self.batch_chain.invoke(self._get_batch_input(queries, knowledge_summary)), len(queries), "general")
+        except Exception as e:
+            print(f"[WATCHMAN AGENT:ERROR] BATCH CLASSIFICATION FAILED, CLASSIFYING ONE BY ONE : {e}")
+            decisions = [None] * len(queries)
+        for i, query in enumerate(queries):
+            if decisions[i] is None:
+                decisions[i] = "yes" in self.guard(query, knowledge_summary).lower()
+        return decisions
+
+    async def aguard_batch(self, queries, knowledge_summary):
+        if len(queries) == 0:
+            return []
+        try:
+            decisions = parse_batch_decisions(await self.batch_chain.ainvoke(self._get_batch_input(queries, knowledge_summary)), len(queries), "general")
+        except Exception as e:
+            print(f"[WATCHMAN AGENT:ERROR] BATCH CLASSIFICATION FAILED, CLASSIFYING ONE BY ONE : {e}")
+            decisions = [None] * len(queries)
+        undecided = [i for i, decision in enumerate(decisions) if decision is None]
+        responses = await asyncio.gather(*[self.aguard(queries[i], knowledge_summary) for i in undecided])
+        for i, response in zip(undecided, responses):
+            decisions[i] = "yes" in response.lower()
+        return decisions
+
+    def _get_batch_input(self, queries, knowledge_summary):
+        return {
+            "count":len(queries),
+            "queries":format_numbered(queries),
+            "knowledge_summary":knowledge_summary
+        }
     
 class GeneralQueryAnsweringAgent:
     def __init__(self, model = "gemini-1.5-flash"):
-        self.gemini_client = ChatGoogleGenerativeAI(model=model)
+        self.gemini_client = agent_registry.get_gemini_client(model)
         self.model = model
 
-    def answer(self, query):
-        prompt = PromptTemplate.from_template("""
+        self.chain = PromptTemplate.from_template("""
             be humble and considerate.
             if the query requires prior knowledge, humbly accept you have no knowledge on that topic    
             dont respond with information not explicitly given to you                                                                                                           
             <Query>{query}</Query>
-        """)
+        """) | self.gemini_client | StrOutputParser()
 
-        chain = prompt | self.gemini_client | StrOutputParser()
+    def answer(self, query):
+        response = self.chain.invoke(query)
+        return response
 
-        response = chain.invoke(query)
+    async def aanswer(self, query):
+        response = await self.chain.ainvoke(query)
         return response
\ No newline at end of file
@@ -0,0 +1,87 @@
+from quart import Quart, Response, request, jsonify, send_file
+
+from ChatbotService import ChatbotService, to_server_sent_event, IMAGE_CACHE_MAX_AGE
+
+from dotenv import load_dotenv
+load_dotenv()
+
+# fully asynchronous front end of the chatbot service, same routes as app.py.
+# requests share one event loop, so llm calls, query embeddings and vector store reads are awaited
+# on the async clients and a single process can hold hundreds of chats in flight.
+# run with: hypercorn asgi:app --bind 0.0.0.0:8000
+app = Quart(__name__)
+
+service = ChatbotService(native_async=True)
+
+@app.before_serving
+async def startup():
+    service.start()
+
+@app.after_serving
+async def shutdown():
+    service.stop()
+
+@app.route('/chatbot/api/v1/health', methods=["GET"])
+async def handle_health_check():
+    payload, status = service.health()
+    return jsonify(payload), status
+
+@app.route('/chatbot/api/v1/connect', methods=['POST'])
+async def handle_connect():
+    payload, status = await service.connect(await request.get_json())
+    return jsonify(payload), status
+
+@app.route("/chatbot/api/v1/config", methods = ["PUT"])
+async def handle_config_update():
+    payload, status = await service.update_config(await request.get_json())
+    return jsonify(payload), status
+
+@app.route('/chatbot/api/v1/query', methods=['POST'])
+async def handle_query():
+    payload, status = await service.query(await request.get_json())
+    return jsonify(payload), status
+
+@app.route('/chatbot/api/v1/query/stream', methods=['POST'])
+async def handle_query_stream():
+    body = await request.get_json()
+
+    async def events():
+        async for event, data in service.query_stream(body):
+            yield to_server_sent_event(event, data)
+
+    response = Response(events(), mimetype="text/event-stream", headers={"Cache-Control":"no-cache", "X-Accel-Buffering":"no"})
+    # a long answer must not be cut off by the default response timeout
+    response.timeout = None
+    return response
+
+# images are content addressed and immutable, served with etags and range support
+@app.route('/chatbot/api/v1/images/<customer_id>/<filename>', methods=['GET'])
+async def handle_image(customer_id, filename):
+    image_path = service.get_image_path(customer_id, filename)
+    if image_path is None:
+        return jsonify({
+            "result":"false",
+            "message":"image not found"
+        }),404
+
+    response = await send_file(image_path, conditional=True, add_etags=True, cache_timeout=IMAGE_CACHE_MAX_AGE)
+    response.headers["Cache-Control"] = f"public, max-age={IMAGE_CACHE_MAX_AGE}, immutable"
+    return response
+
+@app.route('/chatbot/api/v1/knowledge', methods = ['POST'])
+async def handle_upload():
+    payload, status = await service.upload(await request.get_json())
+    return jsonify(payload), status
+
+@app.route('/chatbot/api/v1/knowledge/jobs/<job_id>', methods = ['GET'])
+async def handle_upload_status(job_id):
+    payload, status = await service.upload_status(job_id)
+    return jsonify(payload), status
+
+@app.route("/chatbot/api/v1/knowledge", methods=["DELETE"])
+async def handle_delete():
+    payload, status = await service.delete(await request.get_json())
+    return jsonify(payload), status
+
+if __name__ == '__main__':
+    app.run(port=8000)
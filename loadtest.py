@@ -0,0 +1,78 @@
+import argparse
+import asyncio
+import json
+import time
+import httpx
+
+# load test for the chatbot api, meant to compare the flask dev server (python app.py)
+# with the asgi server (hypercorn asgi:app). every virtual user connects once and then sends
+# its queries one after another, concurrency users are active at the same time.
+#
+# python loadtest.py --base-url http://localhost:8000 --customer-id 1234 --concurrency 100 --requests 500
+
+def percentile(values, p):
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+async def run_user(client, args, user_index, remaining, latencies, errors):
+    user_id = f"loadtest-user-{user_index}"
+    response = await client.post("/chatbot/api/v1/connect", json={"customer_id":args.customer_id, "user_id":user_id})
+    if response.status_code != 200:
+        errors.append(f"connect {response.status_code} : {response.text[:200]}")
+        return
+
+    while remaining[0] > 0:
+        remaining[0] -= 1
+        started_at = time.perf_counter()
+        try:
+            response = await client.post("/chatbot/api/v1/query", json={"customer_id":args.customer_id, "user_id":user_id, "query":args.query})
+            body = response.json()
+            if response.status_code != 200 or body.get("result") != "true":
+                errors.append(f"query {response.status_code} : {body.get('message')}")
+                continue
+        except Exception as e:
+            errors.append(f"query : {e}")
+            continue
+        latencies.append(time.perf_counter() - started_at)
+
+async def main(args):
+    latencies = []
+    errors = []
+    remaining = [args.requests]
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=args.timeout) as client:
+        started_at = time.perf_counter()
+        await asyncio.gather(*(run_user(client, args, i, remaining, latencies, errors) for i in range(args.concurrency)))
+        elapsed = time.perf_counter() - started_at
+
+    report = {
+        "base_url": args.base_url,
+        "concurrency": args.concurrency,
+        "requests": args.requests,
+        "succeeded": len(latencies),
+        "failed": len(errors),
+        "elapsed_seconds": round(elapsed, 2),
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "latency_seconds": {
+            "p50": round(percentile(latencies, 50), 3),
+            "p90": round(percentile(latencies, 90), 3),
+            "p99": round(percentile(latencies, 99), 3),
+            "max": round(max(latencies), 3) if latencies else 0.0
+        },
+        "sample_errors": errors[:5]
+    }
+    print(json.dumps(report, indent=4))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="load test the chatbot query endpoint")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--customer-id", required=True)
+    parser.add_argument("--query", default="what topics does the knowledge base cover?")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--timeout", type=float, default=300)
+    asyncio.run(main(parser.parse_args()))
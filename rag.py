@@ -1,6 +1,7 @@
 from langchain_community.document_loaders import PyPDFLoader, TextLoader
 from ResourceManager import ResourceManager
-from agents import ImageToDescriptionAgent
+from agents import ImageToDescriptionAgent, estimate_tokens
+from AgentRegistry import agent_registry
 from langchain_core.documents import Document
 from langchain_experimental.text_splitter import SemanticChunker
 from langchain_text_splitters import RecursiveCharacterTextSplitter
@@ -8,6 +9,11 @@ from langchain_google_genai import GoogleGenerativeAIEmbeddings
 from io import StringIO
 from langchain_community.vectorstores import FAISS
 from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import base64
+import hashlib
+import numpy as np
 import os
 import fitz
 from VectorStoreInterface import VectorStoreInterface
@@ -20,11 +26,21 @@ load_dotenv()
 from FileSystemInterface import FileSystemInterface
 
 class KnowledgeArtifactLoader:
-    def __init__(self):
-        self.resource_manager = ResourceManager(location_interface_map = {
-             "file_system": FileSystemInterface()
-         })
-        self.image_description_generator = ImageToDescriptionAgent()
+    # images embedded in pdfs smaller than image_min_dimension pixels on either side or image_min_bytes
+    # (icons, bullets, spacers) are skipped. image descriptions run on a pool of image_description_workers
+    # threads shared by every ingestion going through this loader.
+    def __init__(self, resource_manager = None, image_min_dimension = 64, image_min_bytes = 2048, image_description_workers = 4):
+        if resource_manager is None:
+            resource_manager = ResourceManager(location_interface_map = {
+                 "file_system": FileSystemInterface()
+             })
+        self.resource_manager = resource_manager
+        self.image_description_generator = agent_registry.get(ImageToDescriptionAgent)
+
+        self.image_min_dimension = image_min_dimension
+        self.image_min_bytes = image_min_bytes
+        self.image_description_workers = image_description_workers
+        self.image_description_executor = ThreadPoolExecutor(max_workers=image_description_workers, thread_name_prefix="image-describer")
 
     def load_text(self, path, artifact_id):
         try:
@@ -38,79 +54,133 @@ class KnowledgeArtifactLoader:
             print(f"ERROR LOADING TEXT FILE: {e}")
             raise
 
+    # read straight from disk, images are served by reference and not worth a place in the resource cache
     def load_image(self, path, artifact_id):
         try:
             print("LOADING IMAGE")
-            base_64_image = self.resource_manager.get(f'file_system/{path}')
-            description = self.image_description_generator.describe(base_64_image)
-            document = [Document(
-                page_content=description,
-                metadata={"source": path, "artifact_id":artifact_id}
-            )]
-            return document
+            with open(path, "rb") as image_file:
+                base_64_image = base64.b64encode(image_file.read()).decode("utf-8")
+            return [self.describe_image(base_64_image, {"source": path, "artifact_id":artifact_id})]
         except Exception as e:
             print(f"ERROR LOADING AND PROCESSING IMAGE: {e}")
             raise
 
+    # images are stored once per customer under the hash of their content, {sha256}.{extension},
+    # so the same image coming from several pages or artifacts shares one immutable file
+    def save_image(self, directory, image_hash, image_bytes, extension):
+        image_path = f"{directory}/{image_hash}.{extension}"
+        if not os.path.exists(image_path):
+            # written under a temporary name first so a half written image is never served
+            temporary_path = f"{image_path}.{uuid4()}.tmp"
+            with open(temporary_path, "wb") as image_file:
+                image_file.write(image_bytes)
+            os.replace(temporary_path, image_path)
+        return image_path
+
+    # moves an uploaded image file into the content addressed store, returns its new path
+    def store_image_file(self, path):
+        with open(path, "rb") as image_file:
+            image_bytes = image_file.read()
+        extension = os.path.splitext(path)[1].lstrip(".").lower()
+        image_path = self.save_image(os.path.dirname(path), hashlib.sha256(image_bytes).hexdigest(), image_bytes, extension)
+        if os.path.abspath(image_path) != os.path.abspath(path):
+            os.remove(path)
+        return image_path
+
+    def describe_image(self, base_64_image, metadata):
+        description = self.image_description_generator.describe(base_64_image)
+        return Document(
+            page_content=description,
+            metadata=metadata
+        )
+
     def load_pdf(self, path, artifact_id):
+        return list(self.lazy_load_pdf(path, artifact_id))
+
+    # yields one document per page so large pdfs never have to be held in memory at once
+    def lazy_load_pdf(self, path, artifact_id):
         try:
             print("LOADING PDF")
             loader = PyPDFLoader(path)
-            documents = []
             for doc in loader.lazy_load():
-                doc.metadata = {"source": path, "artifact_id":artifact_id}
-                documents.append(doc)
-            return documents
+                doc.metadata = {"source": path, "artifact_id":artifact_id, "page":doc.metadata.get("page")}
+                yield doc
         
         except Exception as e:
             print(f"ERROR LOADING PDF: {e}")
             raise
 
+    # every distinct image of the pdf is saved next to it (see save_image) and described once. images are
+    # de-duplicated by xref (the same image object placed on several pages) and by a hash of their
+    # bytes (identical images stored as separate objects), so a logo repeated on every page costs
+    # a single description. descriptions are generated from the extracted bytes, concurrently.
     def load_images_from_pdf(self, path, artifact_id):
-        # take in pdf,
-        # extract images and save
-        # for each image, load_image(path to image)
-        # return array of documents... we wont split these documents but simply embed it directly.
-
         try:
             print("EXTRACTING IMAGES FROM PDF")
-            pdf = self.resource_manager.get(f'file_system/{path}')
             documents = []
-            
+            in_flight = deque()
+
+            for base_64_image, metadata in self._extract_unique_images(path, artifact_id):
+                in_flight.append(self.image_description_executor.submit(self.describe_image, base_64_image, metadata))
+                # bounds the extracted images held in memory while waiting for a description
+                if len(in_flight) >= self.image_description_workers * 2:
+                    documents.append(in_flight.popleft().result())
+            while in_flight:
+                documents.append(in_flight.popleft().result())
+
+            print(f"[KNOWLEDGE ARTIFACT LOADER] {len(documents)} UNIQUE IMAGES DESCRIBED : {path}")
+            return documents
+        except Exception as e:
+            print(f"ERROR LOADING IMAGES FROM PDF: {e}")
+            raise
+
+    # yields (base 64 image, metadata) for every image worth describing
+    def _extract_unique_images(self, path, artifact_id):
+        # opened directly, a pdf document is not worth caching in the resource manager
+        pdf = fitz.open(path)
+        seen_xrefs = set()
+        seen_hashes = set()
+        skipped = 0
+        try:
             for page in pdf:
-                images = page.get_images(full = True)
-                for i in images:
+                for i in page.get_images(full = True):
                     xref = i[0]
+                    if xref in seen_xrefs:
+                        continue
+                    seen_xrefs.add(xref)
+
                     base_image = pdf.extract_image(xref)
+                    if not base_image:
+                        continue
                     image_bytes = base_image["image"]
-                    image_ext = base_image["ext"]
-                    image_path = f"{os.path.dirname(path)}/{str(uuid4())}.{image_ext}"
-
-                    with open(image_path,"wb") as image_file:
-                        image_file.write(image_bytes)
+                    if len(image_bytes) < self.image_min_bytes or min(base_image["width"], base_image["height"]) < self.image_min_dimension:
+                        skipped += 1
+                        continue
 
-                    documents = documents + self.load_image(image_path, artifact_id)
+                    image_hash = hashlib.sha256(image_bytes).hexdigest()
+                    if image_hash in seen_hashes:
+                        continue
+                    seen_hashes.add(image_hash)
 
+                    image_path = self.save_image(os.path.dirname(path), image_hash, image_bytes, base_image["ext"])
+                    yield base64.b64encode(image_bytes).decode("utf-8"), {"source": image_path, "artifact_id":artifact_id, "page":page.number}
+        finally:
             pdf.close()
-            print(documents)
-            return documents
-        except Exception as e:
-            print(f"ERROR LOADING IMAGES FROM PDF: {e}")
-            raise
+            print(f"[KNOWLEDGE ARTIFACT LOADER] {len(seen_hashes)} UNIQUE IMAGES IN {len(seen_xrefs)} IMAGE OBJECTS, {skipped} BELOW SIZE THRESHOLD : {path}")
         
 class LangchainDocumentsSplitter:
     def __init__(self):
-        self.merger = LangchainDocumentsMerger()
+        self.splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=100)
 
     def split(self, documents):
-        content = self.merger.merge_documents_to_string(documents)
-        splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=100)
-        split_texts = splitter.split_text(content)
-        split_documents = []
-        for text in split_texts:
-            metadata = documents[0].metadata if documents else {}
-            split_documents.append(Document(page_content=text, metadata=metadata))
-        return split_documents
+        return list(self.lazy_split(documents))
+
+    # splits document by document, every chunk keeps the metadata (source, page, ...) of the document it came from.
+    # chunk_index is the position of the chunk within that document, consecutive chunks overlap by chunk_overlap characters
+    def lazy_split(self, documents):
+        for document in documents:
+            for chunk_index, text in enumerate(self.splitter.split_text(document.page_content)):
+                yield Document(page_content=text, metadata={**document.metadata, "chunk_index": chunk_index})
 
 class LangchainDocumentsMerger:
     def __init__(self):
@@ -132,6 +202,126 @@ class LangchainDocumentsMerger:
         )]
         return document
     
+# builds the context of the answering agent from the documents retrieved for every sub-query.
+# sub-queries overlap, so a chunk retrieved several times is kept once (with its best score), consecutive
+# chunks of the same document are merged without their overlap, and the chunks are ranked by score
+# (or by maximal marginal relevance when mmr_lambda is set) and packed until token_budget is reached.
+class ContextBuilder:
+    def __init__(self, token_budget = 3000, mmr_lambda = None, min_overlap = 10):
+        self.token_budget = token_budget
+        self.mmr_lambda = mmr_lambda
+        # shorter common affixes of consecutive chunks are taken as a coincidence, not as the splitter overlap
+        self.min_overlap = min_overlap
+
+    # pinned documents (e.g. relevant images) are always part of the context and count against the budget.
+    # vectors maps chunk ids to their embeddings, chunks missing from it are only ranked by score
+    def build(self, documents, pinned_documents = (), vectors = None):
+        return LangchainDocumentsMerger().merge_documents_to_string(self.select(documents, pinned_documents, vectors))
+
+    def select(self, documents, pinned_documents = (), vectors = None):
+        pinned_documents = self._deduplicate(pinned_documents)
+        pinned_keys = {self._get_key(d) for d in pinned_documents}
+        documents = [d for d in self._deduplicate(documents) if self._get_key(d) not in pinned_keys]
+
+        if self.mmr_lambda is not None and vectors:
+            ranked_documents = self._rank_by_mmr(documents, vectors)
+        else:
+            ranked_documents = sorted(documents, key=self._get_score, reverse=True)
+
+        used_tokens = sum(estimate_tokens(d.page_content) for d in pinned_documents)
+        selected = []
+        for d in ranked_documents:
+            tokens = estimate_tokens(d.page_content)
+            # a smaller chunk further down may still fit
+            if used_tokens + tokens > self.token_budget:
+                continue
+            selected.append(d)
+            used_tokens += tokens
+
+        print(f"[CONTEXT BUILDER] PACKED {len(selected)} OF {len(ranked_documents)} UNIQUE CHUNKS INTO {used_tokens} OF {self.token_budget} TOKENS")
+        return self._merge_consecutive(selected) + pinned_documents
+
+    def _get_key(self, document):
+        return document.metadata.get("id") or document.page_content
+
+    # reranked chunks are ranked by their cross-encoder score. with the reranker enabled every chunk has
+    # one, so cross-encoder and retrieval scores are never compared with each other
+    def _get_score(self, document):
+        score = document.metadata.get("rerank_score")
+        if score is None:
+            score = document.metadata.get("score")
+        return score if score is not None else float("-inf")
+
+    def _deduplicate(self, documents):
+        unique_documents = {}
+        for d in documents:
+            key = self._get_key(d)
+            if key not in unique_documents or self._get_score(d) > self._get_score(unique_documents[key]):
+                unique_documents[key] = d
+        return list(unique_documents.values())
+
+    # greedily picks the chunk maximizing mmr_lambda * relevance - (1 - mmr_lambda) * its highest similarity
+    # to the chunks picked before it. relevance is the retrieval score scaled to [0, 1]
+    def _rank_by_mmr(self, documents, vectors):
+        if len(documents) == 0:
+            return []
+        scores = np.array([self._get_score(d) for d in documents], dtype=np.float64)
+        scores[np.isinf(scores)] = np.min(scores[~np.isinf(scores)]) if np.any(~np.isinf(scores)) else 0.0
+        spread = scores.max() - scores.min()
+        relevance = (scores - scores.min()) / spread if spread > 0 else np.ones(len(documents))
+
+        matrix = np.zeros((len(documents), len(next(iter(vectors.values())))), dtype=np.float32)
+        for i, d in enumerate(documents):
+            vector = vectors.get(d.metadata.get("id"))
+            if vector is not None:
+                norm = np.linalg.norm(vector)
+                matrix[i] = vector / norm if norm != 0 else vector
+        similarities = matrix @ matrix.T
+
+        ranked = []
+        max_similarity = np.zeros(len(documents))
+        remaining = list(range(len(documents)))
+        while remaining:
+            mmr_scores = self.mmr_lambda * relevance[remaining] - (1 - self.mmr_lambda) * max_similarity[remaining]
+            best = remaining.pop(int(np.argmax(mmr_scores)))
+            ranked.append(documents[best])
+            max_similarity = np.maximum(max_similarity, similarities[best])
+        return ranked
+
+    # consecutive chunks of the same document become one document, in the place of the best ranked of them
+    def _merge_consecutive(self, documents):
+        runs = {}
+        for rank, d in enumerate(documents):
+            if d.metadata.get("chunk_index") is None:
+                runs[(rank,)] = [(rank, d)]
+                continue
+            parent = tuple(d.metadata.get(key) for key in ("artifact_id", "source", "page"))
+            runs.setdefault(parent, []).append((rank, d))
+
+        merged_documents = []
+        for run in runs.values():
+            run.sort(key=lambda item: item[1].metadata.get("chunk_index") or 0)
+            rank, merged = run[0]
+            last_chunk_index = merged.metadata.get("chunk_index")
+            for next_rank, d in run[1:]:
+                if d.metadata["chunk_index"] == last_chunk_index + 1:
+                    merged = Document(page_content=self._join_overlapping(merged.page_content, d.page_content), metadata=dict(merged.metadata))
+                    rank = min(rank, next_rank)
+                else:
+                    merged_documents.append((rank, merged))
+                    rank, merged = next_rank, d
+                last_chunk_index = d.metadata["chunk_index"]
+            merged_documents.append((rank, merged))
+
+        merged_documents.sort(key=lambda item: item[0])
+        return [d for rank, d in merged_documents]
+
+    def _join_overlapping(self, first, second):
+        for size in range(min(len(first), len(second)), self.min_overlap - 1, -1):
+            if first.endswith(second[:size]):
+                return first + second[size:]
+        return first + "\n" + second
+
 # class LangchainDocumentChunksEmbedder:
 #     def __init__(self, model = "models/embedding-001"):
 #         self.embedder = GoogleGenerativeAIEmbeddings(model=model)
@@ -220,14 +410,46 @@ class LangchainDocumentsMerger:
 #         return retriever.invoke(query)
 
 class VectorStoreManager:
-    def __init__(self, db_url = None, db_name = None):
-        self.vector_store_interface = VectorStoreInterface(db_url=db_url, db_name=db_name)
+    def __init__(self, db_url = None, db_name = None, index_mode = "flat", retrieval_mode = "vector", lexical_weight = 0.5, rrf_k = 60, lexical_prefilter_size = None, embedding_batch_size = 100, embedding_max_concurrent_batches = 4, embedding_cache_size = 10000, embedding_disk_cache_directory = None, embedding_disk_cache_size_limit = 2**30, index_sync_interval = 5):
+        self.vector_store_interface = VectorStoreInterface(
+            db_url=db_url,
+            db_name=db_name,
+            index_mode=index_mode,
+            retrieval_mode=retrieval_mode,
+            lexical_weight=lexical_weight,
+            rrf_k=rrf_k,
+            lexical_prefilter_size=lexical_prefilter_size,
+            embedding_batch_size=embedding_batch_size,
+            embedding_max_concurrent_batches=embedding_max_concurrent_batches,
+            embedding_cache_size=embedding_cache_size,
+            embedding_disk_cache_directory=embedding_disk_cache_directory,
+            embedding_disk_cache_size_limit=embedding_disk_cache_size_limit,
+            index_sync_interval=index_sync_interval
+        )
 
     def embed(self, vector_store_name, documents):
         return self.vector_store_interface.embed(vector_store_name, documents)
     
-    def retrieve(self, vector_store_name, query):
-        return self.vector_store_interface.retrieve(vector_store_name, query)
+    def embed_query(self, query):
+        return self.vector_store_interface.embed_query(query)
+
+    async def aembed_query(self, query):
+        return await self.vector_store_interface.aembed_query(query)
+
+    def retrieve(self, vector_store_name, query, query_vector = None, k = 5):
+        return self.vector_store_interface.retrieve(vector_store_name, query, k=k, query_vector=query_vector)
+
+    async def aretrieve(self, vector_store_name, query, query_vector = None, k = 5):
+        return await self.vector_store_interface.aretrieve(vector_store_name, query, k=k, query_vector=query_vector)
+
+    def load_known_collections(self):
+        return self.vector_store_interface.load_known_collections()
+
+    def get_vectors(self, vector_store_name, ids):
+        return self.vector_store_interface.get_vectors(vector_store_name, ids)
+
+    def get_embedding_cache_stats(self):
+        return self.vector_store_interface.embedder.get_stats()
         
-    def delete(self, vector_store_name, key, values):
-        return self.vector_store_interface.delete_by_field(vector_store_name, key, values)
\ No newline at end of file
+    def delete(self, vector_store_name, key, values, validate_field = True):
+        return self.vector_store_interface.delete_by_field(vector_store_name, key, values, validate_field=validate_field)
\ No newline at end of file